@@ -0,0 +1,4 @@
+# Offline benchmarks of the spider callbacks, run on saved pages
+# (see README). Run them from the scraper directory, e.g. :
+#
+#     python -m benchmarks.match_list .scrapy/archive/espn.archive
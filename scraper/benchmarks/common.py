@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import glob
+
+from dateutil import parser as dateparser
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from rugby.archive import ResponseArchive
+from rugby.items import Match, Player
+from rugby.spiders.espn import ESPN
+
+def load_pages(source, url_contains = None, limit = None):
+    """ Returns the saved pages as (url, body, meta) tuples. The source is either a response
+    archive recorded by a crawl, or a directory of .html files with an optional .json sidecar
+    file holding the url and meta of each page.
+    """
+    pages = []
+    if os.path.isdir(source):
+        for path in sorted(glob.glob(os.path.join(source, "*.html"))):
+            sidecar = os.path.splitext(path)[0] + ".json"
+            info = json.load(open(sidecar)) if os.path.exists(sidecar) else {}
+            with open(path, "rb") as f:
+                pages.append((info.get("url", "file://" + os.path.abspath(path)), f.read(), info.get("meta", {})))
+    else:
+        archive = ResponseArchive(source)
+        try:
+            for url in archive:
+                record = archive.get(url)
+                pages.append((record["url"], record["body"], record["meta"]))
+        finally:
+            archive.close()
+
+    if url_contains:
+        pages = [page for page in pages if url_contains in page[0]]
+    return pages[:limit] if limit else pages
+
+def restore_meta(meta):
+    """ Turns the items forwarded in a saved meta back into Match/Player items """
+    meta = dict(meta)
+    if "match" in meta:
+        meta["match"] = Match(meta["match"])
+        if isinstance(meta["match"].get("date"), str):
+            meta["match"]["date"] = dateparser.parse(meta["match"]["date"])
+    if "player_info" in meta:
+        meta["player_info"] = Player(meta["player_info"])
+    return meta
+
+def make_response(url, body, meta):
+    return HtmlResponse(url = url, body = body, request = Request(url, meta = restore_meta(meta)))
+
+def make_spider(settings = None):
+    """ Returns a spider bound to a crawler (for settings and stats) that never touches the DB or the network """
+    crawler = get_crawler(ESPN, settings)
+    spider = ESPN.from_crawler(crawler)
+    spider.follow_pages = False
+    return spider
+
+def timed(function, inputs, repeat = 3):
+    """ Calls function on every input, repeat times. Returns the outputs of the last run and the best time """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        outputs = [function(value) for value in inputs]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return outputs, best
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""Compares the single-pass match list parser with the previous implementation on saved result pages.
+
+    python -m benchmarks.match_list SOURCE [--limit N] [--repeat N]
+"""
+
+import argparse
+
+from rugby.items import Match
+from rugby.loaders import MatchLoader
+
+from benchmarks.common import load_pages, make_response, make_spider, timed
+
+def legacy_match_list_parse(spider, response):
+    """ Previous implementation of ESPN.match_list_parse : one loader per side menu div, with
+    nested selectors run against the whole page (quadratic in the number of rows) """
+    matches = []
+    offset = None
+    for index, links in enumerate(response.css(".engine-dd")):
+        if links.css("[id^=\"engine-dd-\"]"):
+            continue
+        if not offset:
+            offset = index - 1
+        loader = MatchLoader(item = Match(), response = response)
+        link_block_loader = loader.nested_css("#engine-dd{}".format(index - offset))
+        for field, selector in spider.match_link_fields.items():
+            link_block_loader.add_css(field, selector, re = "\/([0-9]+)\.")
+        table_row_loader = loader.nested_css("tr.data1:nth-child({})".format(index - offset))
+        for field, selector in spider.match_row_fields.items():
+            table_row_loader.add_css(field, selector)
+        loader.add_value("match_type", response.meta["home_or_away"])
+        match = loader.load_item()
+        if any(k not in match.keys() for k in ["id", "home_team_id", "away_team_id", "match_type", "won", "date"]):
+            continue
+        matches.append(match)
+    return matches
+
+def current_match_list_parse(spider, response):
+    return [request.meta["match"] for request in spider.match_list_parse(response) if "match" in request.meta]
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[0])
+    parser.add_argument("source", help = "response archive or directory of saved result pages")
+    parser.add_argument("--limit", type = int, default = None)
+    parser.add_argument("--repeat", type = int, default = 3)
+    args = parser.parse_args()
+
+    spider = make_spider({"LOG_LEVEL": "ERROR"})
+    pages = load_pages(args.source, url_contains = spider.search_path, limit = args.limit)
+    if not pages:
+        parser.error("No result pages found in \"{}\"".format(args.source))
+    responses = [make_response(*page) for page in pages]
+
+    results = {}
+    for name, function in [("legacy", legacy_match_list_parse), ("single-pass", current_match_list_parse)]:
+        outputs, elapsed = timed(lambda response: function(spider, response), responses, args.repeat)
+        results[name] = (outputs, elapsed)
+        matches = sum(len(output) for output in outputs)
+        print("{:<12} {:>6} pages {:>8} matches {:>9.3f}s {:>9.1f} pages/s".format(name, len(responses), matches, elapsed, len(responses) / elapsed))
+
+    mismatches = [
+        response.url for response, legacy, current in zip(responses, results["legacy"][0], results["single-pass"][0])
+        if [dict(item) for item in legacy] != [dict(item) for item in current]
+    ]
+    print("Speed-up : x{:.1f}".format(results["legacy"][1] / results["single-pass"][1]))
+    print("Identical output on {}/{} pages".format(len(responses) - len(mismatches), len(responses)))
+    for url in mismatches:
+        print("  differs : {}".format(url))
+
+if __name__ == "__main__":
+    main()
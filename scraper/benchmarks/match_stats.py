@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""Compares the table-driven "Match stats" parser with the previous if-chain on saved match iframes.
+
+    python -m benchmarks.match_stats SOURCE [--limit N] [--repeat N]
+"""
+
+import argparse
+from collections import defaultdict
+
+import regex
+
+from benchmarks.common import load_pages, make_response, make_spider, timed
+
+def legacy_parse_match_stats(tab, match):
+    """ Previous implementation of ESPN._parse_match_stats : if-chain on the stat title, with
+    the codes dict rebuilt and the patterns compiled for every value """
+    for stat in tab.css("table tr"):
+        title = stat.css("td:nth-child(2)::text").extract_first()
+        if not title:
+            continue
+        values = [stat.css("td:nth-child({})::text".format(i)).extract_first() for i in [1, 3]]
+        ids = [match["home_team_id"], match["away_team_id"]]
+        if not all(values):
+            continue
+        result = defaultdict(dict)
+
+        for team_id, value in zip(ids, values):
+            if title == "Penalty goals":
+                cons_attempt_re = regex.match("[0-9]+ from ([0-9]+)", value)
+                if not cons_attempt_re:
+                    continue
+                result["pens_attempt"][team_id] = int(cons_attempt_re.captures(1)[0])
+            if title == "Dropped goals":
+                drops_re = regex.match("([0-9]+)( \(([0-9]+) missed\))?", value)
+                if not drops_re:
+                    continue
+                drops_scored = int(drops_re.captures(1)[0])
+                drops_missed = drops_re.captures(3)
+                drops_missed = int(drops_missed[0]) if drops_missed else 0
+                result["drops_attempt"][team_id] = drops_scored + drops_missed
+            codes = {
+                "Kicks from hand": "kicks",
+                "Passes": "passes",
+                "Runs": "runs",
+                "Metres run with ball": "meters",
+                "Clean breaks": "breaks",
+                "Defenders beaten": "def_beaten",
+                "Offloads": "offloads",
+                "Turnovers conceded": "turnovers",
+                "Penalties conceded": "pens_conceded",
+            }
+            if title in ["Kicks from hand", "Passes", "Runs", "Metres run with ball", "Clean breaks", "Defenders beaten", "Offloads", "Turnovers conceded", "Penalties conceded"]:
+                result[codes.get(title)][team_id] = int(value)
+            for name, prefix in [("Rucks won", "rucks"), ("Mauls won", "mall")]:
+                if title == name:
+                    rucks_re = regex.match("^\\n([0-9]+) from ([0-9]+)", value)
+                    if not rucks_re:
+                        continue
+                    result[prefix + "_init"][team_id] = int(rucks_re.captures(2)[0])
+                    result[prefix + "_won"][team_id] = int(rucks_re.captures(1)[0])
+            for name, fields in [("Tackles made/missed", ("tackles_made", "tackles_missed")), ("Yellow/red cards", ("yellow_cards", "red_cards"))]:
+                if title == name:
+                    pair_re = regex.match("^([0-9]+)/([0-9]+)$", value)
+                    if not pair_re:
+                        continue
+                    result[fields[0]][team_id] = int(pair_re.captures(1)[0])
+                    result[fields[1]][team_id] = int(pair_re.captures(2)[0])
+            for name, fields in [("Scrums on own feed", ("scrums_won_on_feed", "scrums_lost_on_feed")), ("Lineouts on own throw", ("lineouts_won_on_throw", "lineouts_lost_on_throw"))]:
+                if title == name:
+                    won_lost_re = regex.match("^\\n\\t  ([0-9]+) won, ([0-9]+) lost", value)
+                    if not won_lost_re:
+                        continue
+                    result[fields[0]][team_id] = int(won_lost_re.captures(1)[0])
+                    result[fields[1]][team_id] = int(won_lost_re.captures(2)[0])
+
+        for metric_name, metric_values in result.items():
+            yield metric_name, metric_values
+
+def match_stats_tabs(responses):
+    """ Returns the (tab, match) pairs of the pages having a "Match stats" tab """
+    tabs = []
+    for response in responses:
+        match = response.meta.get("match")
+        if not match:
+            continue
+        for tab in response.css("#scrumContent .tabbertab"):
+            if tab.css("h2::text").extract_first() == "Match stats":
+                tabs.append((tab, match))
+    return tabs
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[0])
+    parser.add_argument("source", help = "response archive or directory of saved match iframes")
+    parser.add_argument("--limit", type = int, default = None)
+    parser.add_argument("--repeat", type = int, default = 5)
+    args = parser.parse_args()
+
+    spider = make_spider({"LOG_LEVEL": "ERROR"})
+    tabs = match_stats_tabs(make_response(*page) for page in load_pages(args.source, limit = args.limit))
+    if not tabs:
+        parser.error("No \"Match stats\" tab found in \"{}\"".format(args.source))
+
+    results = {}
+    for name, function in [("if-chain", legacy_parse_match_stats), ("registry", spider._parse_match_stats)]:
+        outputs, elapsed = timed(lambda tab_match: sorted(function(*tab_match)), tabs, args.repeat)
+        results[name] = (outputs, elapsed)
+        print("{:<10} {:>6} tabs {:>9.3f}s {:>9.1f} tabs/s".format(name, len(tabs), elapsed, len(tabs) / elapsed))
+
+    identical = sum(legacy == current for legacy, current in zip(results["if-chain"][0], results["registry"][0]))
+    print("Speed-up : x{:.1f}".format(results["if-chain"][1] / results["registry"][1]))
+    print("Identical output on {}/{} tabs".format(identical, len(tabs)))
+    unknown = {key: value for key, value in spider.crawler.stats.get_stats().items() if key.startswith("espn/match_stats/unknown/")}
+    for key, count in sorted(unknown.items()):
+        print("  unknown title \"{}\" : {}".format(key.split("/", 3)[3], count // args.repeat))
+
+if __name__ == "__main__":
+    main()
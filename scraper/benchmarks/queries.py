@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""Times common read queries on a synthetic DB, without and with the lookup indexes of the models.
+
+    python -m benchmarks.queries [--matches N] [--db PATH] [--repeat N]
+
+The DB is filled with the synthetic crawl items of benchmarks.storage (unless --db points to an
+existing DB). The indexes are dropped for the first run, then created again by models.migrate,
+as for an existing DB.
+"""
+
+import os
+import time
+import random
+import logging
+import argparse
+import tempfile
+
+from sqlalchemy import text
+from scrapy.utils.test import get_crawler
+
+from rugby import models, database
+from rugby.storage import SQLiteStorage
+
+from benchmarks.storage import crawl_items, batches
+
+QUERIES = [
+    ("events of a player", "SELECT * FROM events WHERE player_id = :player_id"),
+    ("player stats of a match", "SELECT * FROM playerstats WHERE match_id = :match_id"),
+    ("extra stats of a match", "SELECT * FROM playerextrastats WHERE match_id = :match_id"),
+    ("career totals of a player", "SELECT SUM(tries), SUM(meters), SUM(tackles_made) FROM playerextrastats WHERE player_id = :player_id"),
+    ("season of a team", "SELECT * FROM matchs WHERE (home_team_id = :team_id OR away_team_id = :team_id) AND date BETWEEN :start AND :end"),
+    ("averages of a team", "SELECT AVG(meters), AVG(passes) FROM matchextrastats WHERE team_id = :team_id"),
+    ("pipeline upsert lookup", "SELECT id, player_id, team_id, match_id FROM playerstats WHERE match_id IN ({match_ids})"),
+]
+
+def fill(path, matches):
+    crawler = get_crawler(settings_dict = {"SQLITE_ABS_PATH": path})
+    storage = SQLiteStorage.from_settings(crawler.settings, crawler.stats)
+    storage.open(logging.getLogger("benchmark"))
+    for batch in batches(crawl_items(matches), 5000):
+        storage.write(batch)
+    storage.close()
+
+def parameters(engine, count, seed = 0):
+    """ Returns count sets of query parameters, picked among the stored entries """
+    rand = random.Random(seed)
+    match_ids = [id for id, in engine.execute("SELECT id FROM matchs")]
+    player_ids = [id for id, in engine.execute("SELECT id FROM players")]
+    team_ids = [id for id, in engine.execute("SELECT id FROM teams")]
+    years = [int(year) for year, in engine.execute("SELECT DISTINCT strftime('%Y', date) FROM matchs")]
+    params = []
+    for i in range(count):
+        year = rand.choice(years)
+        params.append({
+            "player_id": rand.choice(player_ids),
+            "match_id": rand.choice(match_ids),
+            "team_id": rand.choice(team_ids),
+            "start": "{}-01-01".format(year),
+            "end": "{}-12-31".format(year),
+            "match_ids": ", ".join(str(id) for id in rand.sample(match_ids, min(20, len(match_ids)))),
+        })
+    return params
+
+def run(engine, params):
+    """ Returns the mean time of each query (in ms) and its query plan """
+    results = []
+    connection = engine.connect()
+    try:
+        for name, sql in QUERIES:
+            statements = [(text(sql.format(match_ids = param["match_ids"])), param) for param in params]
+            plan = connection.execute(text("EXPLAIN QUERY PLAN " + sql.format(match_ids = params[0]["match_ids"])), params[0]).fetchall()
+            start = time.perf_counter()
+            for statement, param in statements:
+                connection.execute(statement, param).fetchall()
+            results.append(((time.perf_counter() - start) * 1000 / len(params), "; ".join(row[-1] for row in plan)))
+    finally:
+        connection.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[0])
+    parser.add_argument("--matches", type = int, default = 5000)
+    parser.add_argument("--db", help = "existing DB to use (its indexes are dropped and created again)")
+    parser.add_argument("--repeat", type = int, default = 50)
+    args = parser.parse_args()
+
+    path = args.db
+    if not path:
+        path = os.path.join(tempfile.mkdtemp(), "queries.db")
+        start = time.time()
+        fill(path, args.matches)
+        print("Filled a DB with {} matches in {:.1f}s".format(args.matches, time.time() - start))
+
+    engine = database.get_engine(get_crawler(settings_dict = {"SQLITE_ABS_PATH": path}).settings)
+    for table in models.Base.metadata.sorted_tables:
+        count = engine.execute("SELECT COUNT(*) FROM {}".format(table.name)).scalar()
+        print("{:<20} {:>9} rows".format(table.name, count))
+    params = parameters(engine, args.repeat)
+
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            engine.execute("DROP INDEX IF EXISTS {}".format(index.name))
+    before = run(engine, params)
+
+    start = time.time()
+    models.migrate(engine)
+    engine.execute("ANALYZE")
+    print("Indexes created in {:.1f}s\n".format(time.time() - start))
+    after = run(engine, params)
+
+    print("{:<28} {:>12} {:>12} {:>9}".format("query (ms)", "no index", "indexed", "speed-up"))
+    for (name, sql), (slow, slow_plan), (fast, fast_plan) in zip(QUERIES, before, after):
+        print("{:<28} {:>12.3f} {:>12.3f} {:>8.0f}x".format(name, slow, fast, slow / fast))
+        print("    {}".format(fast_plan))
+
+    if not args.db:
+        os.remove(path)
+
+if __name__ == "__main__":
+    main()
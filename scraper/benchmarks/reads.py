@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""Times the match series of players loaded as ORM objects, and with rugby.query (without and with its cache).
+
+    python -m benchmarks.reads [--matches N] [--db PATH] [--repeat N]
+
+The DB is filled with the synthetic crawl items of benchmarks.storage (unless --db points to an
+existing DB). Each query is run for --repeat random players, the cached run queries them again.
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+from sqlalchemy.orm import sessionmaker
+from scrapy.utils.test import get_crawler
+
+from rugby import models, database
+from rugby.query import Reader
+
+from benchmarks.queries import fill, parameters
+
+def orm_series(session, player_id):
+    """ Match series of a player the ad-hoc way : model objects, converted to columns in Python """
+    rows = session.query(models.PlayerStats, models.Match.date).join(models.Match, models.Match.id == models.PlayerStats.match_id) \
+        .filter(models.PlayerStats.player_id == player_id).order_by(models.Match.date).all()
+    extra = {(stats.match_id, stats.team_id): stats for stats in session.query(models.PlayerExtraStats).filter_by(player_id = player_id)}
+    return {
+        "date": [date for stats, date in rows],
+        "tries": [stats.tries for stats, date in rows],
+        "meters": [getattr(extra.get((stats.match_id, stats.team_id)), "meters", None) for stats, date in rows],
+    }
+
+def timed(function, player_ids):
+    start = time.perf_counter()
+    for player_id in player_ids:
+        function(player_id)
+    return (time.perf_counter() - start) * 1000 / len(player_ids)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[0])
+    parser.add_argument("--matches", type = int, default = 5000)
+    parser.add_argument("--db", help = "existing DB to use")
+    parser.add_argument("--repeat", type = int, default = 100)
+    args = parser.parse_args()
+
+    path = args.db
+    if not path:
+        path = os.path.join(tempfile.mkdtemp(), "reads.db")
+        start = time.time()
+        fill(path, args.matches)
+        print("Filled a DB with {} matches in {:.1f}s".format(args.matches, time.time() - start))
+
+    engine = database.get_engine(get_crawler(settings_dict = {"SQLITE_ABS_PATH": path}).settings)
+    player_ids = [param["player_id"] for param in parameters(engine, args.repeat)]
+    session = sessionmaker(bind = engine)()
+    reader = Reader(engine, cache_size = args.repeat)
+    uncached = Reader(engine, cache_size = 0)
+
+    results = [
+        ("ORM objects", timed(lambda player_id: orm_series(session, player_id), player_ids)),
+        ("rugby.query", timed(uncached.player_matches, player_ids)),
+    ]
+    timed(reader.player_matches, player_ids)
+    results.append(("rugby.query, cached", timed(reader.player_matches, player_ids)))
+    session.close()
+    reader.close()
+    uncached.close()
+
+    print("{:<24} {:>12}".format("player series", "ms / query"))
+    for name, elapsed in results:
+        print("{:<24} {:>12.3f}".format(name, elapsed))
+
+    if not args.db:
+        os.remove(path)
+
+if __name__ == "__main__":
+    main()
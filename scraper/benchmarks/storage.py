@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""Compares the write throughput of the storage backends on batches of synthetic crawl items.
+
+    python -m benchmarks.storage [--postgres URL] [--matches N] [--batch-size N] [--repeat N]
+
+The tables of the target DBs are dropped before every run : use scratch DBs
+(a temporary SQLite file is used for SQLiteStorage). After each run, the first batch
+is written again, which must leave the aggregate tables unchanged (exit code 1 otherwise).
+"""
+
+import os
+import random
+import logging
+import argparse
+import sys
+import datetime
+import tempfile
+from collections import defaultdict
+
+from sqlalchemy import select
+from scrapy.utils.test import get_crawler
+
+from rugby import items, models
+from rugby.storage import SQLiteStorage, PostgresStorage
+
+def crawl_items(matches, seed = 0):
+    """ Yields (item class, row) pairs in the order a crawl of that many matches would produce them """
+    rand = random.Random(seed)
+    date = datetime.datetime(2010, 1, 1)
+    for match_id in range(1, matches + 1):
+        teams = rand.sample(range(1, 60), 2)
+        for team_id in teams:
+            yield items.Team, {"id": team_id, "name": "Team {}".format(team_id)}
+        yield items.Match, {"id": match_id, "home_team_id": teams[0], "away_team_id": teams[1], "ground_id": rand.randint(1, 300),
+            "won": rand.randint(0, 2), "match_type": rand.randint(1, 4), "date": date + datetime.timedelta(days = match_id)}
+        for index, team_id in enumerate(teams):
+            yield items.MatchStats, {"match_id": match_id, "team_id": team_id, "scored": rand.randint(0, 50), "conceded": rand.randint(0, 50),
+                "tries": rand.randint(0, 6), "cons": rand.randint(0, 6), "pens": rand.randint(0, 6), "drops": 0}
+            yield items.MatchExtraStats, {"match_id": match_id, "team_id": team_id, "kicks": rand.randint(0, 40), "passes": rand.randint(50, 200),
+                "runs": rand.randint(50, 150), "meters": rand.randint(100, 800), "tackles_made": rand.randint(50, 150)}
+            squad = rand.sample(range(1, 41), 23)
+            for number in range(1, 24):
+                player_id = team_id * 1000 + squad[number - 1]
+                yield items.Player, {"id": player_id, "name": "Player {}".format(player_id)}
+                yield items.PlayerStats, {"player_id": player_id, "team_id": team_id, "match_id": match_id, "number": number,
+                    "position": "FB", "first_team": number <= 15}
+                if number <= 15:
+                    yield items.PlayerExtraStats, {"player_id": player_id, "team_id": team_id, "match_id": match_id, "tries": rand.randint(0, 2),
+                        "passes": rand.randint(0, 30), "runs": rand.randint(0, 20), "meters": rand.randint(0, 150), "tackles_made": rand.randint(0, 20)}
+                if rand.random() < 0.2:
+                    yield items.GameEvent, {"player_id": player_id, "team_id": team_id, "match_id": match_id, "time": rand.randint(1, 80), "action_type": "tries"}
+                    yield items.PlayerStats, {"player_id": player_id, "team_id": team_id, "match_id": match_id, "tries": 1}
+
+def batches(rows, batch_size):
+    batch, size = defaultdict(list), 0
+    for item_class, row in rows:
+        batch[item_class].append(row)
+        size += 1
+        if size >= batch_size:
+            yield batch
+            batch, size = defaultdict(list), 0
+    if size:
+        yield batch
+
+def totals(engine):
+    """ Rows of the aggregate tables """
+    return {table.name: sorted(engine.execute(select([table])).fetchall()) for table in models.Base.metadata.sorted_tables if table.info.get("aggregate")}
+
+def run(backend, settings, rows, batch_size):
+    """ Writes the rows to an empty DB, then the first batch again. Returns the elapsed time, the number of
+    rejected batches and whether the aggregate tables were left unchanged by the rewrite. """
+    crawler = get_crawler(settings_dict = settings)
+    storage = backend.from_settings(crawler.settings, crawler.stats)
+    models.Base.metadata.drop_all(storage.engine)
+    storage.close()
+
+    storage = backend.from_settings(crawler.settings, crawler.stats)
+    storage.open(logging.getLogger("benchmark"))
+    rejected = 0
+    start = datetime.datetime.now()
+    for batch in batches(rows, batch_size):
+        rejected += not storage.write(batch)
+    elapsed = (datetime.datetime.now() - start).total_seconds()
+
+    # Entries written again are updated in place, and counted once in the totals
+    before = totals(storage.engine)
+    rejected += not storage.write(next(batches(rows, batch_size)))
+    unchanged = totals(storage.engine) == before
+    storage.close()
+    return elapsed, rejected, unchanged
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[0])
+    parser.add_argument("--postgres", help = "URL of a scratch PostgreSQL DB, e.g. postgresql://user@localhost/rugby_bench")
+    parser.add_argument("--matches", type = int, default = 500)
+    parser.add_argument("--batch-size", type = int, default = 500)
+    parser.add_argument("--repeat", type = int, default = 3)
+    args = parser.parse_args()
+
+    rows = list(crawl_items(args.matches))
+    path = os.path.join(tempfile.mkdtemp(), "storage.db")
+    backends = [("SQLiteStorage", SQLiteStorage, {"SQLITE_ABS_PATH": path})]
+    if args.postgres:
+        backends.append(("PostgresStorage", PostgresStorage, {"DATABASE_URL": args.postgres}))
+
+    print("{} items, batches of {}".format(len(rows), args.batch_size))
+    failed = False
+    for name, backend, settings in backends:
+        elapsed, rejected, unchanged = min(run(backend, settings, rows, args.batch_size) for i in range(args.repeat))
+        print("{:<16} {:>9.3f}s {:>10.0f} items/s {:>4} rejected batches, totals {} by a rewrite".format(
+            name, elapsed, len(rows) / elapsed, rejected, "unchanged" if unchanged else "CHANGED"))
+        failed = failed or not unchanged
+    os.remove(path)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""Runs the spider callbacks over the saved HTML fixtures, reports their speed and memory use,
+and checks their output against the golden JSON files.
+
+    python -m benchmarks.suite [--repeat N] [--only CALLBACK] [--update-golden]
+    python -m benchmarks.suite --extract ARCHIVE [--per-callback N]
+
+Fixtures live in benchmarks/fixtures/<set>/<name>.html, with a <name>.json sidecar holding
+the url and meta of the page. Golden outputs live in benchmarks/golden/<callback>/<name>.json.
+A callback without fixtures, or a fixture without a golden output, fails the run : golden
+outputs are only written with --update-golden.
+"""
+
+import os
+import sys
+import json
+import argparse
+import datetime
+import tracemalloc
+from collections import OrderedDict
+
+from scrapy import Item, Request
+
+from rugby.archive import ResponseArchive
+from benchmarks.common import load_pages, make_response, make_spider, timed
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(ROOT, "fixtures")
+GOLDEN = os.path.join(ROOT, "golden")
+
+# Fields whose value depends on the time of the run
+VOLATILE_FIELDS = {"fetched_at"}
+
+def match_stats_tabs(spider, response):
+    for tab in response.css("#scrumContent .tabbertab"):
+        if tab.css("h2::text").extract_first() == "Match stats":
+            return sorted(spider._parse_match_stats(tab, response.meta["match"]))
+    return []
+
+# Callback -> (fixture set, function returning the outputs of the callback for a response)
+CALLBACKS = OrderedDict([
+    ("match_list_parse", ("match_list", lambda spider, response: list(spider.match_list_parse(response)))),
+    ("_match_iframe_parse", ("match_iframe", lambda spider, response: list(spider._match_iframe_parse(response)))),
+    ("player_info_parse", ("player_info", lambda spider, response: list(spider.player_info_parse(response)))),
+    ("_parse_match_stats", ("match_iframe", match_stats_tabs)),
+])
+
+def classify(url, meta, spider):
+    """ Returns the fixture set of an archived page, or None if it isn't used by the suite """
+    if spider.search_path in url:
+        return "match_list"
+    if "/statsguru/rugby/player/" in url:
+        return "player_info"
+    if "match" in meta and "/statsguru/rugby/match/" not in url:
+        return "match_iframe"
+    return None
+
+def serialize(output):
+    """ Turns callback outputs into plain JSON values """
+    if isinstance(output, Item):
+        fields = {key: serialize(value) for key, value in output.items() if key not in VOLATILE_FIELDS}
+        return {"type": output.__class__.__name__, "fields": fields}
+    if isinstance(output, Request):
+        return {"type": "Request", "url": output.url, "callback": getattr(output.callback, "__name__", None)}
+    if isinstance(output, (datetime.date, datetime.datetime)):
+        return output.isoformat()
+    if isinstance(output, dict):
+        return {str(key): serialize(value) for key, value in output.items()}
+    if isinstance(output, (list, tuple)):
+        return [serialize(value) for value in output]
+    return output
+
+def fixture_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def extract(archive_path, per_callback):
+    """ Copies pages of a recorded archive into the fixture sets """
+    spider = make_spider({"LOG_LEVEL": "ERROR"})
+    archive = ResponseArchive(archive_path)
+    counts = {}
+    try:
+        for url in archive:
+            record = archive.get(url)
+            fixture_set = classify(record["url"], record["meta"], spider)
+            if not fixture_set or counts.get(fixture_set, 0) >= per_callback:
+                continue
+            counts[fixture_set] = counts.get(fixture_set, 0) + 1
+            directory = os.path.join(FIXTURES, fixture_set)
+            os.makedirs(directory, exist_ok = True)
+            name = "{:04d}".format(counts[fixture_set])
+            with open(os.path.join(directory, name + ".html"), "wb") as f:
+                f.write(record["body"])
+            with open(os.path.join(directory, name + ".json"), "w") as f:
+                json.dump({"url": record["url"], "meta": record["meta"]}, f, indent = 2, sort_keys = True)
+    finally:
+        archive.close()
+    for fixture_set, count in sorted(counts.items()):
+        print("{:<14} {} fixtures".format(fixture_set, count))
+
+def run(callback, repeat, update_golden):
+    """ Benchmarks one callback, returns the names of the fixtures whose output differs from the golden one
+    (or has no golden output), or None if the callback has no fixtures """
+    fixture_set, function = CALLBACKS[callback]
+    directory = os.path.join(FIXTURES, fixture_set)
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".html")) if os.path.isdir(directory) else []
+    if not paths:
+        print("{:<20} no fixtures in {}".format(callback, directory))
+        return None
+
+    spider = make_spider({"LOG_LEVEL": "ERROR", "PLAYER_PROFILE_TTL": 0})
+    pages = load_pages(directory)
+    call = lambda response: function(spider, response)
+
+    # Callbacks fill the items forwarded in the meta, so every run gets fresh responses
+    elapsed = None
+    for i in range(repeat):
+        outputs, best = timed(call, [make_response(*page) for page in pages], 1)
+        elapsed = best if elapsed is None else min(elapsed, best)
+
+    # Peak memory is measured in a separate run, tracing allocations slows everything down
+    responses = [make_response(*page) for page in pages]
+    tracemalloc.start()
+    for response in responses:
+        call(response)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    items = sum(len(output) for output in outputs)
+    print("{:<20} {:>5} pages {:>7} outputs {:>9.1f} pages/s {:>10.1f} outputs/s {:>8.1f} MiB peak".format(
+        callback, len(pages), items, len(pages) / elapsed, items / elapsed, peak / 2 ** 20))
+
+    # Compare with (or update) the golden outputs
+    mismatches = []
+    golden_directory = os.path.join(GOLDEN, callback)
+    for path, output in zip(paths, outputs):
+        golden_path = os.path.join(golden_directory, fixture_name(path) + ".json")
+        output = serialize(output)
+        if update_golden:
+            os.makedirs(golden_directory, exist_ok = True)
+            with open(golden_path, "w") as f:
+                json.dump(output, f, indent = 1, sort_keys = True)
+        elif not os.path.exists(golden_path):
+            mismatches.append(fixture_name(path) + " (no golden output)")
+        else:
+            with open(golden_path) as f:
+                if json.load(f) != output:
+                    mismatches.append(fixture_name(path))
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[0])
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--only", choices = list(CALLBACKS.keys()), action = "append")
+    parser.add_argument("--update-golden", action = "store_true", help = "overwrite the golden outputs with the current ones")
+    parser.add_argument("--extract", metavar = "ARCHIVE", help = "populate the fixtures from a recorded response archive")
+    parser.add_argument("--per-callback", type = int, default = 50, help = "number of fixtures extracted per set")
+    args = parser.parse_args()
+
+    if args.extract:
+        return extract(args.extract, args.per_callback)
+
+    failed = False
+    for callback in args.only or CALLBACKS.keys():
+        mismatches = run(callback, args.repeat, args.update_golden)
+        if mismatches is None:
+            failed = True
+        elif mismatches:
+            failed = True
+            print("  output differs from golden on : {}".format(", ".join(mismatches)))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
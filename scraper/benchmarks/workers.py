@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""Compares the throughput of the match iframe parser in the reactor thread and in a pool of worker processes.
+
+    python -m benchmarks.workers SOURCE [--workers N [N ...]] [--limit N] [--repeat N]
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from rugby import items
+from rugby.workers import parse_iframe
+
+from benchmarks.common import load_pages, make_response, make_spider, timed
+from benchmarks.suite import classify
+
+def in_reactor(spider, pages):
+    return [list(spider._match_iframe_parse(make_response(*page))) for page in pages]
+
+def in_pool(executor, pages):
+    responses = [make_response(*page) for page in pages]
+    records = executor.map(parse_iframe, *zip(*[
+        (response.url, response.body, response.encoding, dict(response.meta["match"])) for response in responses
+    ]))
+    # Items are rebuilt in the main process, as the spider does
+    return [
+        [data if kind == "Player request" else getattr(items, kind)(data) for kind, data in record["results"]]
+        for record in records
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split("\n")[0])
+    parser.add_argument("source", help = "response archive or directory of saved match iframes")
+    parser.add_argument("--workers", type = int, nargs = "+", default = [2, os.cpu_count() or 2])
+    parser.add_argument("--limit", type = int, default = None)
+    parser.add_argument("--repeat", type = int, default = 3)
+    args = parser.parse_args()
+
+    spider = make_spider({"LOG_LEVEL": "ERROR"})
+    pages = [page for page in load_pages(args.source) if classify(page[0], page[2], spider) == "match_iframe"][:args.limit]
+    if not pages:
+        parser.error("No match iframes found in \"{}\"".format(args.source))
+
+    # Every run gets fresh responses, the parser fills the forwarded match items
+    outputs, elapsed = timed(lambda pages: in_reactor(spider, pages), [pages], args.repeat)
+    print("{:<12} {:>6} pages {:>8} items {:>9.3f}s {:>9.1f} pages/s".format(
+        "in reactor", len(pages), sum(len(output) for output in outputs[0]), elapsed, len(pages) / elapsed))
+
+    for workers in args.workers:
+        with ProcessPoolExecutor(workers) as executor:
+            # Start the processes and load the parser before timing
+            in_pool(executor, pages[:workers])
+            outputs, elapsed = timed(lambda pages: in_pool(executor, pages), [pages], args.repeat)
+        print("{:<12} {:>6} pages {:>8} items {:>9.3f}s {:>9.1f} pages/s".format(
+            "{} workers".format(workers), len(pages), sum(len(output) for output in outputs[0]), elapsed, len(pages) / elapsed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+""" Maintenance of the aggregate tables (career totals of the players, season totals of the teams).
+
+The pipeline refreshes the totals of the players and team seasons of every batch it writes, in the same
+transaction : their rows are computed again from the stats tables, which only reads the stats of these
+players and teams through the lookup indexes. Recomputing the affected rows, rather than adding the new
+values, keeps the totals right when partial items are merged into existing stats or a match is written
+again. "scrapy aggregates" rebuilds the tables from scratch (after a merge or a manual change of the DB).
+"""
+
+from sqlalchemy import select, func, case, extract, and_, bindparam
+
+from rugby import models, items
+
+PLAYER_STATS = ["tries", "cons", "pens", "drops"]
+PLAYER_EXTRA_STATS = ["points", "assists", "kicks", "passes", "runs", "meters", "breaks", "def_beaten", "offloads",
+    "turnovers", "tackles_made", "tackles_missed", "yellow_cards", "red_cards"]
+TEAM_STATS = ["scored", "conceded", "tries", "cons", "pens", "drops"]
+TEAM_EXTRA_STATS = ["kicks", "passes", "runs", "meters", "breaks", "offloads", "turnovers", "tackles_made",
+    "tackles_missed", "yellow_cards", "red_cards"]
+
+# Maximum number of keys per statement
+chunk_size = 500
+
+def _chunks(values):
+    values = sorted(values)
+    for i in range(0, len(values), chunk_size):
+        yield values[i:i + chunk_size]
+
+def player_totals(filtered = False):
+    """ Query of the rows of playertotals, for all the players or the ones of the "player_ids" parameter """
+    stats, extra = models.PlayerStats.__table__, models.PlayerExtraStats.__table__
+    per_player = select(
+        [stats.c.player_id, func.count(stats.c.match_id.distinct()).label("matches"),
+        func.sum(case([(stats.c.first_team, 1)], else_ = 0)).label("first_team_matches")] +
+        [func.sum(stats.c[name]).label(name) for name in PLAYER_STATS]
+    ).group_by(stats.c.player_id)
+    extra_per_player = select(
+        [extra.c.player_id] + [func.sum(extra.c[name]).label(name) for name in PLAYER_EXTRA_STATS]
+    ).group_by(extra.c.player_id)
+    if filtered:
+        per_player = per_player.where(stats.c.player_id.in_(bindparam("player_ids", expanding = True)))
+        extra_per_player = extra_per_player.where(extra.c.player_id.in_(bindparam("player_ids", expanding = True)))
+
+    per_player, extra_per_player = per_player.alias("stats"), extra_per_player.alias("extra")
+    return select(
+        [per_player.c[name] for name in ["player_id", "matches", "first_team_matches"] + PLAYER_STATS] +
+        [extra_per_player.c[name] for name in PLAYER_EXTRA_STATS]
+    ).select_from(per_player.outerjoin(extra_per_player, extra_per_player.c.player_id == per_player.c.player_id))
+
+def team_season_totals(filtered = False):
+    """ Query of the rows of teamseasontotals, for all the teams and seasons or the ones of the "team_ids" and "seasons" parameters """
+    stats, extra, matchs = models.MatchStats.__table__, models.MatchExtraStats.__table__, models.Match.__table__
+    season = extract("year", matchs.c.date)
+    per_season = select(
+        [stats.c.team_id, season.label("season"), func.count().label("matches"),
+        func.sum(case([(stats.c.scored > stats.c.conceded, 1)], else_ = 0)).label("won"),
+        func.sum(case([(stats.c.scored == stats.c.conceded, 1)], else_ = 0)).label("drawn"),
+        func.sum(case([(stats.c.scored < stats.c.conceded, 1)], else_ = 0)).label("lost")] +
+        [func.sum(stats.c[name]).label(name) for name in TEAM_STATS]
+    ).select_from(stats.join(matchs, matchs.c.id == stats.c.match_id)).group_by(stats.c.team_id, season)
+    extra_per_season = select(
+        [extra.c.team_id, season.label("season")] + [func.sum(extra.c[name]).label(name) for name in TEAM_EXTRA_STATS]
+    ).select_from(extra.join(matchs, matchs.c.id == extra.c.match_id)).group_by(extra.c.team_id, season)
+    if filtered:
+        per_season = per_season.where(and_(stats.c.team_id.in_(bindparam("team_ids", expanding = True)), season.in_(bindparam("seasons", expanding = True))))
+        extra_per_season = extra_per_season.where(and_(extra.c.team_id.in_(bindparam("team_ids", expanding = True)), season.in_(bindparam("seasons", expanding = True))))
+
+    per_season, extra_per_season = per_season.alias("stats"), extra_per_season.alias("extra")
+    return select(
+        [per_season.c[name] for name in ["team_id", "season", "matches", "won", "drawn", "lost"] + TEAM_STATS] +
+        [extra_per_season.c[name] for name in TEAM_EXTRA_STATS]
+    ).select_from(per_season.outerjoin(extra_per_season, and_(
+        extra_per_season.c.team_id == per_season.c.team_id, extra_per_season.c.season == per_season.c.season)))
+
+def _insert(table, query):
+    return table.insert().from_select([column.name for column in query.columns], query)
+
+# The refresh statements are built once, and compiled once per dialect (the lists of keys are
+# expanded at execution time)
+PLAYERS = models.PlayerTotals.__table__
+TEAM_SEASONS = models.TeamSeasonTotals.__table__
+MATCHS = models.Match.__table__
+
+DELETE_PLAYERS = PLAYERS.delete().where(PLAYERS.c.player_id.in_(bindparam("player_ids", expanding = True)))
+INSERT_PLAYERS = _insert(PLAYERS, player_totals(filtered = True))
+DELETE_TEAM_SEASONS = TEAM_SEASONS.delete().where(and_(
+    TEAM_SEASONS.c.team_id.in_(bindparam("team_ids", expanding = True)), TEAM_SEASONS.c.season.in_(bindparam("seasons", expanding = True))))
+INSERT_TEAM_SEASONS = _insert(TEAM_SEASONS, team_season_totals(filtered = True))
+SEASONS = select([MATCHS.c.home_team_id, MATCHS.c.away_team_id, extract("year", MATCHS.c.date)]).where(MATCHS.c.id.in_(bindparam("match_ids", expanding = True)))
+
+compiled_cache = {}
+
+def refresh(session, batch):
+    """ Refreshes the totals of the players and team seasons with stats in a batch (item class -> rows), in the
+    transaction of the session. Team seasons are refreshed for every season of the batch's matches, for each of
+    their teams. Returns the number of players and team seasons refreshed.
+    """
+    connection = session.connection().execution_options(compiled_cache = compiled_cache)
+
+    player_ids = {int(row["player_id"]) for item_class in (items.PlayerStats, items.PlayerExtraStats) for row in batch.get(item_class, ())}
+    for chunk in _chunks(player_ids):
+        connection.execute(DELETE_PLAYERS, player_ids = chunk)
+        connection.execute(INSERT_PLAYERS, player_ids = chunk)
+
+    match_ids = {int(row["match_id"]) for item_class in (items.MatchStats, items.MatchExtraStats) for row in batch.get(item_class, ())}
+    team_ids, seasons = set(), set()
+    for chunk in _chunks(match_ids):
+        for home_team_id, away_team_id, season in connection.execute(SEASONS, match_ids = chunk):
+            team_ids.update([home_team_id, away_team_id])
+            seasons.add(season)
+    if team_ids:
+        connection.execute(DELETE_TEAM_SEASONS, team_ids = sorted(team_ids), seasons = sorted(seasons))
+        connection.execute(INSERT_TEAM_SEASONS, team_ids = sorted(team_ids), seasons = sorted(seasons))
+    return len(player_ids), len(team_ids) * len(seasons)
+
+def rebuild(connection):
+    """ Computes all the totals again. Returns the number of rows of each aggregate table. """
+    counts = {}
+    for table, query in [(models.PlayerTotals.__table__, player_totals()), (models.TeamSeasonTotals.__table__, team_season_totals())]:
+        connection.execute(table.delete())
+        connection.execute(_insert(table, query))
+        counts[table.name] = connection.execute(select([func.count()]).select_from(table)).scalar()
+    return counts
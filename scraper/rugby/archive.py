@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import zlib
+import struct
+import datetime
+
+from scrapy import Item
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.url import canonicalize_url
+
+class ResponseArchive(object):
+    """ Append-only file of compressed HTTP responses, indexed by URL.
+
+    Each record is laid out as : URL length and payload length (2 x uint32), URL, payload.
+    The payload is the zlib-compressed concatenation of a JSON header (length-prefixed) and the raw body.
+    The index is rebuilt by skipping from URL to URL when the archive is opened; when a URL
+    has been recorded several times, the last record wins.
+    """
+
+    record_header = struct.Struct(">II")
+    payload_header = struct.Struct(">I")
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self.file = open(path, "ab+")
+        self._load_index()
+
+    def _load_index(self):
+        self.file.seek(0)
+        offset = 0
+        while True:
+            header = self.file.read(self.record_header.size)
+            if len(header) < self.record_header.size:
+                break
+            url_length, payload_length = self.record_header.unpack(header)
+            url = self.file.read(url_length).decode("utf-8")
+            start = offset + self.record_header.size + url_length
+            if start + payload_length > os.fstat(self.file.fileno()).st_size:
+                # Truncated record (interrupted crawl), ignore it
+                break
+            self.index[url] = (start, payload_length)
+            offset = start + payload_length
+            self.file.seek(offset)
+
+    def __contains__(self, url):
+        return canonicalize_url(url) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index.keys())
+
+    def get(self, url):
+        """ Returns the archived record of a URL as a dict (url, status, headers, meta, body), or None """
+        location = self.index.get(canonicalize_url(url))
+        if not location:
+            return None
+        self.file.seek(location[0])
+        payload = zlib.decompress(self.file.read(location[1]))
+        header_length, = self.payload_header.unpack_from(payload)
+        record = json.loads(payload[self.payload_header.size:self.payload_header.size + header_length].decode("utf-8"))
+        record["body"] = payload[self.payload_header.size + header_length:]
+        return record
+
+    def put(self, url, status, headers, body, meta = None):
+        key = canonicalize_url(url).encode("utf-8")
+        header = json.dumps({
+            "url": url,
+            "status": status,
+            "headers": headers,
+            "meta": self._snapshot(meta or {}),
+        }).encode("utf-8")
+        payload = zlib.compress(self.payload_header.pack(len(header)) + header + body)
+
+        self.file.seek(0, os.SEEK_END)
+        start = self.file.tell() + self.record_header.size + len(key)
+        self.file.write(self.record_header.pack(len(key), len(payload)) + key + payload)
+        self.index[key.decode("utf-8")] = (start, len(payload))
+
+    def _snapshot(self, meta):
+        """ Keeps the JSON-serializable part of the request meta (forwarded items included),
+        so that archived pages can be parsed again outside of a crawl """
+        def default(value):
+            if isinstance(value, Item):
+                return dict(value)
+            if isinstance(value, (datetime.date, datetime.datetime)):
+                return value.isoformat()
+            raise TypeError
+
+        snapshot = {}
+        for key, value in meta.items():
+            try:
+                snapshot[key] = json.loads(json.dumps(value, default = default))
+            except (TypeError, ValueError):
+                continue
+        return snapshot
+
+    def close(self):
+        self.file.close()
+
+class ArchiveCacheStorage(object):
+    """ HTTP cache storage backed by a ResponseArchive (one archive file per spider in HTTPCACHE_DIR).
+    Record a crawl with HTTPCACHE_ENABLED, replay it without network by also setting HTTPCACHE_IGNORE_MISSING.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings["HTTPCACHE_DIR"], createdir = True)
+        self.archive = None
+
+    def open_spider(self, spider):
+        self.archive = ResponseArchive(os.path.join(self.cachedir, "{}.archive".format(spider.name)))
+        spider.logger.info("Using response archive \"{}\" ({} responses)".format(self.archive.path, len(self.archive)))
+
+    def close_spider(self, spider):
+        self.archive.close()
+
+    def retrieve_response(self, spider, request):
+        record = self.archive.get(request.url)
+        if record is None:
+            return None
+        headers = Headers(record["headers"])
+        respcls = responsetypes.from_args(headers = headers, url = record["url"], body = record["body"])
+        return respcls(url = record["url"], headers = headers, status = record["status"], body = record["body"])
+
+    def store_response(self, spider, request, response):
+        headers = {
+            key.decode("latin-1"): [value.decode("latin-1") for value in values]
+            for key, values in response.headers.items()
+        }
+        self.archive.put(request.url, response.status, headers, response.body, request.meta)
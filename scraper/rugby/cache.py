@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+class IdSet(object):
+    """Compact set of positive integer IDs, stored as a growable bitmap (one bit per possible ID).
+    ESPN ids are dense enough for this to be a lot smaller than a set() of ints."""
+
+    def __init__(self, ids = ()):
+        self.bits = bytearray()
+        self.count = 0
+        self.update(ids)
+
+    def __contains__(self, id):
+        if id is None or id < 0:
+            return False
+        byte = id >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (id & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, id):
+        if id is None or id < 0:
+            return
+        byte = id >> 3
+        if byte >= len(self.bits):
+            # Grow by at least 50% to keep the number of reallocations low
+            self.bits.extend(bytes(max(byte + 1 - len(self.bits), len(self.bits) >> 1)))
+        mask = 1 << (id & 7)
+        if not self.bits[byte] & mask:
+            self.bits[byte] |= mask
+            self.count += 1
+
+    def update(self, ids):
+        for id in ids:
+            self.add(id)
@@ -0,0 +1,4 @@
+# Maintenance commands of the project (see COMMANDS_MODULE in settings), run
+# from the scraper directory, e.g. :
+#
+#     scrapy merge /tmp/shard_*.db
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from rugby import aggregates, database
+
+class Command(ScrapyCommand):
+    """ Rebuilds the aggregate tables (playertotals, teamseasontotals) of the DB from the stats tables, in one transaction.
+    The pipeline keeps them up to date during the crawls, this is for backfills and DBs changed by other means.
+    """
+
+    requires_project = True
+
+    def syntax(self):
+        return ""
+
+    def short_desc(self):
+        return "Rebuild the player and team season totals"
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        start = time.time()
+        engine = database.get_engine(self.settings)
+        with engine.begin() as connection:
+            counts = aggregates.rebuild(connection)
+        print("Rebuilt the totals in {:.1f}s : {}".format(time.time() - start, ", ".join("{} {}".format(count, table) for table, count in counts.items())))
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import sqlite3
+
+from sqlalchemy import create_engine
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from rugby import models, database
+
+# Version of the compact layout, stored in the "user_version" of the DB
+SCHEMA_VERSION = 2
+
+# Compact layout of the high-volume tables : no surrogate ID, the natural key is the primary key of a
+# WITHOUT ROWID table (the rows are stored in the primary key B-tree, sorted by match), and the text
+# columns with few distinct values are replaced by codes of lookup tables. Events have no natural key :
+# "seq" numbers the events of a player with the same minute and action type.
+SCHEMA = [
+    "CREATE TABLE action_types (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+    "CREATE TABLE positions (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+    """CREATE TABLE playerstats (
+        match_id INTEGER NOT NULL REFERENCES matchs (id),
+        team_id INTEGER NOT NULL REFERENCES teams (id),
+        player_id INTEGER NOT NULL REFERENCES players (id),
+        position_id INTEGER REFERENCES positions (id),
+        number INTEGER,
+        first_team INTEGER NOT NULL,
+        tries INTEGER,
+        cons INTEGER,
+        pens INTEGER,
+        drops INTEGER,
+        PRIMARY KEY (match_id, team_id, player_id)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX ix_playerstats_player ON playerstats (player_id, match_id)",
+    """CREATE TABLE playerextrastats (
+        match_id INTEGER NOT NULL REFERENCES matchs (id),
+        team_id INTEGER NOT NULL REFERENCES teams (id),
+        player_id INTEGER NOT NULL REFERENCES players (id),
+        {},
+        PRIMARY KEY (match_id, team_id, player_id)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX ix_playerextrastats_player ON playerextrastats (player_id, match_id)",
+    """CREATE TABLE events (
+        match_id INTEGER NOT NULL REFERENCES matchs (id),
+        team_id INTEGER NOT NULL REFERENCES teams (id),
+        player_id INTEGER NOT NULL REFERENCES players (id),
+        time INTEGER NOT NULL,
+        action_type_id INTEGER NOT NULL REFERENCES action_types (id),
+        seq INTEGER NOT NULL,
+        extra_info TEXT,
+        PRIMARY KEY (match_id, team_id, player_id, time, action_type_id, seq)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX ix_events_player ON events (player_id, match_id)",
+]
+
+# Tables converted to the compact layout, the others are copied as they are
+COMPACT_TABLES = ["playerstats", "playerextrastats", "events"]
+
+# Queries timed by the report, on the current and the compact layout : full scans, and reads of the
+# rows of a range of matches (clustered together in the compact tables)
+SCANS = [
+    ("playerstats scan", "SELECT COUNT(*), SUM(tries), SUM(first_team) FROM playerstats", None),
+    ("playerextrastats scan", "SELECT COUNT(DISTINCT player_id), SUM(meters), SUM(tackles_made) FROM playerextrastats", None),
+    ("events scan", "SELECT COUNT(*) FROM events WHERE action_type = 'tries'",
+        "SELECT COUNT(*) FROM events WHERE action_type_id = (SELECT id FROM action_types WHERE name = 'tries')"),
+    ("playerstats 100 matches", "SELECT * FROM playerstats WHERE match_id IN (SELECT id FROM matchs ORDER BY id LIMIT 100 OFFSET (SELECT COUNT(*) / 2 FROM matchs))", None),
+    ("playerextrastats 100 matches", "SELECT * FROM playerextrastats WHERE match_id IN (SELECT id FROM matchs ORDER BY id LIMIT 100 OFFSET (SELECT COUNT(*) / 2 FROM matchs))", None),
+]
+
+class Command(ScrapyCommand):
+    """ Converts the DB of the settings (SQLITE_ABS_PATH) into a new DB with the compact layout (schema v2)
+    of playerstats, playerextrastats and events, and reports the size and scan time of both layouts.
+
+    The compact stats tables are keyed by (match_id, team_id, player_id), like the unique keys of the current layout.
+    Events are keyed by player, minute, action type and a sequence number, so that every event is kept. The conversion
+    fails if any row would be lost. The positions and action types are stored as codes of the positions and
+    action_types tables. The other tables are copied as they are. The compact DB is meant for analysis, the crawls
+    keep writing to the current layout.
+    """
+
+    requires_project = True
+
+    def syntax(self):
+        return "OUT_DB"
+
+    def short_desc(self):
+        return "Convert the DB to the compact layout and report the gains"
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        path = args[0]
+        if os.path.exists(path):
+            raise UsageError("\"{}\" already exists".format(path), print_help = False)
+
+        # Make sure the source DB has an up to date schema
+        source = self.settings.get("SQLITE_ABS_PATH")
+        database.get_engine(self.settings).dispose()
+
+        if sqlite3.sqlite_version_info < (3, 25, 0):
+            raise UsageError("The conversion needs SQLite 3.25+ (window functions)", print_help = False)
+
+        start = time.time()
+        self.create(path)
+        connection = sqlite3.connect(path, isolation_level = None)
+        try:
+            try:
+                counts = self.convert(connection, source)
+            finally:
+                connection.close()
+        except ValueError as e:
+            os.remove(path)
+            raise UsageError(str(e), print_help = False)
+        print("Converted {} into {} in {:.1f}s : {}".format(source, path, time.time() - start, ", ".join("{} {}".format(count, table) for table, count in counts.items())))
+        self.report(source, path)
+
+    def create(self, path):
+        # Tables kept as they are, with the same indexes as in the current layout
+        engine = create_engine("sqlite:///" + path)
+        models.Base.metadata.create_all(engine, tables = [table for table in models.Base.metadata.sorted_tables if table.name not in COMPACT_TABLES])
+        engine.dispose()
+
+        stats = ",\n        ".join("{} INTEGER".format(column.name) for column in models.PlayerExtraStats.__table__.columns
+            if column.name not in ("id", "match_id", "team_id", "player_id"))
+        connection = sqlite3.connect(path)
+        try:
+            for statement in SCHEMA:
+                connection.execute(statement.format(stats))
+            connection.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def convert(self, connection, source):
+        counts = {}
+        connection.execute("ATTACH DATABASE ? AS source", (source,))
+        connection.execute("BEGIN")
+        try:
+            for table in models.Base.metadata.sorted_tables:
+                if table.name in COMPACT_TABLES:
+                    continue
+                columns = ", ".join(column.name for column in table.columns)
+                order = ", ".join(column.name for column in table.primary_key.columns)
+                connection.execute("INSERT INTO main.{0} ({1}) SELECT {1} FROM source.{0} ORDER BY {2}".format(table.name, columns, order))
+
+            # Codes of the enum values, and of the positions found in the DB
+            for code, name in enumerate(models.GameEvent.__table__.c.action_type.type.enums, 1):
+                connection.execute("INSERT INTO action_types (id, name) VALUES (?, ?)", (code, name))
+            connection.execute("INSERT INTO positions (name) SELECT DISTINCT position FROM source.playerstats WHERE position IS NOT NULL ORDER BY position")
+
+            # Rows are inserted in primary key order. The keys are unique in the source, a duplicate fails the conversion.
+            connection.execute("""INSERT INTO main.playerstats
+                SELECT s.match_id, s.team_id, s.player_id, p.id, s.number, s.first_team, s.tries, s.cons, s.pens, s.drops
+                FROM source.playerstats s LEFT JOIN positions p ON p.name = s.position
+                ORDER BY s.match_id, s.team_id, s.player_id""")
+            columns = ", ".join(column.name for column in models.PlayerExtraStats.__table__.columns if column.name != "id")
+            connection.execute("""INSERT INTO main.playerextrastats ({0})
+                SELECT {0} FROM source.playerextrastats ORDER BY match_id, team_id, player_id""".format(columns))
+            connection.execute("""INSERT INTO main.events
+                SELECT e.match_id, e.team_id, e.player_id, e.time, a.id,
+                    ROW_NUMBER() OVER (PARTITION BY e.match_id, e.team_id, e.player_id, e.time, a.id ORDER BY e.id), e.extra_info
+                FROM source.events e JOIN action_types a ON a.name = e.action_type
+                ORDER BY e.match_id, e.team_id, e.player_id, e.time, a.id, e.id""")
+
+            for table in COMPACT_TABLES:
+                before = connection.execute("SELECT COUNT(*) FROM source.{}".format(table)).fetchone()[0]
+                after = connection.execute("SELECT COUNT(*) FROM main.{}".format(table)).fetchone()[0]
+                if after != before:
+                    raise ValueError("{} of the {} rows of {} would be lost, nothing was converted".format(before - after, before, table))
+            connection.execute("COMMIT")
+        except sqlite3.IntegrityError as e:
+            connection.execute("ROLLBACK")
+            raise ValueError("Duplicate key in the source DB ({}), nothing was converted".format(e))
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.execute("DETACH DATABASE source")
+
+        for table in models.Base.metadata.sorted_tables:
+            counts[table.name] = connection.execute("SELECT COUNT(*) FROM {}".format(table.name)).fetchone()[0]
+        connection.execute("ANALYZE")
+        return counts
+
+    def sizes(self, path):
+        """ Size of each table of a DB, including its indexes (needs the dbstat virtual table) """
+        connection = sqlite3.connect(path)
+        try:
+            return dict(connection.execute("""SELECT m.tbl_name, SUM(d.pgsize) FROM dbstat d
+                JOIN sqlite_master m ON m.name = d.name GROUP BY m.tbl_name"""))
+        except sqlite3.OperationalError:
+            return {}
+        finally:
+            connection.close()
+
+    def scan(self, path, query, repeat = 5):
+        connection = sqlite3.connect(path)
+        try:
+            best = None
+            for i in range(repeat):
+                start = time.perf_counter()
+                connection.execute(query).fetchall()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            return best
+        finally:
+            connection.close()
+
+    def report(self, source, path):
+        before, after = self.sizes(source), self.sizes(path)
+        if before and after:
+            print("\n{:<30} {:>10} {:>10} {:>9}".format("size (KiB)", "current", "compact", "ratio"))
+            for table in COMPACT_TABLES:
+                print("{:<30} {:>10.0f} {:>10.0f} {:>8.1f}x".format(table, before[table] / 1024, after[table] / 1024, before[table] / after[table]))
+        print("{:<30} {:>10.0f} {:>10.0f} {:>8.1f}x".format("DB file", os.path.getsize(source) / 1024, os.path.getsize(path) / 1024, os.path.getsize(source) / os.path.getsize(path)))
+
+        print("\n{:<30} {:>10} {:>10} {:>9}".format("query (ms)", "current", "compact", "speed-up"))
+        for name, query, compact_query in SCANS:
+            slow, fast = self.scan(source, query), self.scan(path, compact_query or query)
+            print("{:<30} {:>10.1f} {:>10.1f} {:>8.1f}x".format(name, slow * 1000, fast * 1000, slow / fast))
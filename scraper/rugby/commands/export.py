@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import time
+
+from sqlalchemy import select, Integer, SmallInteger, Float, Boolean, DateTime, Enum, String, Text
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from rugby import models, database
+from rugby.storage import Storage
+
+# Optional dependency, only needed by this command
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Tables the crawls only insert into, exported incrementally
+APPEND_ONLY = {model.__tablename__ for model, strategy, keys in Storage.tables.values() if strategy == "insert"}
+
+class Command(ScrapyCommand):
+    """ Exports every table of the DB to compressed Parquet files, one directory per table (DIR/<table>/*.parquet).
+
+    Rows are streamed in chunks of EXPORT_CHUNK_SIZE rows (one row group each), with compact types : int32 IDs
+    and totals, int16 per-match stats, timestamp dates and dictionary-encoded enums. Running the export again on
+    the same directory only appends the rows added since the previous export to the tables the crawls only
+    insert into (their IDs only grow, and the range of IDs of each file is in its name). The other tables are
+    updated in place by the crawls (upserts, aggregates), so they are rewritten every time.
+    """
+
+    requires_project = True
+
+    def syntax(self):
+        return "DIR"
+
+    def short_desc(self):
+        return "Export the DB to Parquet files (incremental)"
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        if pyarrow is None:
+            raise UsageError("The export needs pyarrow : pip install pyarrow", print_help = False)
+
+        self.chunk_size = self.settings.getint("EXPORT_CHUNK_SIZE", 50000)
+        self.compression = self.settings.get("EXPORT_COMPRESSION", "zstd")
+        engine = database.get_engine(self.settings)
+        for table in models.Base.metadata.sorted_tables:
+            start = time.time()
+            directory = os.path.join(args[0], table.name)
+            os.makedirs(directory, exist_ok = True)
+            if table.name in APPEND_ONLY:
+                rows = self.append(engine, table, directory)
+            else:
+                rows = self.rewrite(engine, table, directory)
+            print("{:<20} {:>9} rows exported in {:.1f}s".format(table.name, rows, time.time() - start))
+
+    def schema(self, table):
+        fields = []
+        for column in table.columns:
+            if isinstance(column.type, Enum):
+                type = pyarrow.dictionary(pyarrow.int8(), pyarrow.string())
+            elif isinstance(column.type, Integer) and (column.primary_key or column.foreign_keys or column.name.endswith("_id") or table.info.get("aggregate")):
+                # IDs (ESPN ones included) and totals over many matches don't fit in 16 bits
+                type = pyarrow.int32()
+            elif isinstance(column.type, (Integer, SmallInteger)):
+                type = pyarrow.int16()
+            elif isinstance(column.type, Float):
+                type = pyarrow.float32()
+            elif isinstance(column.type, Boolean):
+                type = pyarrow.bool_()
+            elif isinstance(column.type, DateTime):
+                type = pyarrow.timestamp("s")
+            elif isinstance(column.type, (String, Text)):
+                type = pyarrow.string()
+            else:
+                raise ValueError("No Parquet type for column {}.{}".format(table.name, column.name))
+            fields.append(pyarrow.field(column.name, type, nullable = column.nullable))
+        return pyarrow.schema(fields)
+
+    def batch(self, schema, rows):
+        arrays = []
+        for index, field in enumerate(schema):
+            values = [row[index] for row in rows]
+            if pyarrow.types.is_dictionary(field.type):
+                arrays.append(pyarrow.array(values, type = pyarrow.string()).dictionary_encode().cast(field.type))
+            else:
+                arrays.append(pyarrow.array(values, type = field.type))
+        return pyarrow.RecordBatch.from_arrays(arrays, schema = schema)
+
+    def write(self, engine, table, query, directory):
+        """ Streams the result of a query into a temporary Parquet file of the directory.
+        Returns its path (None if there was no row), the number of rows and the last ID written.
+        """
+        schema = self.schema(table)
+        path = os.path.join(directory, ".export.parquet")
+        count, last_id = 0, None
+        writer = pyarrow.parquet.ParquetWriter(path, schema, compression = self.compression)
+        try:
+            result = engine.execute(query)
+            while True:
+                rows = result.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                writer.write_table(pyarrow.Table.from_batches([self.batch(schema, rows)]))
+                count += len(rows)
+                last_id = rows[-1]["id"] if "id" in table.columns else None
+        finally:
+            writer.close()
+        if not count:
+            os.remove(path)
+            return None, 0, None
+        return path, count, last_id
+
+    def rewrite(self, engine, table, directory):
+        path, count, last_id = self.write(engine, table, select([table]).order_by(*table.primary_key.columns), directory)
+        full = os.path.join(directory, "full.parquet")
+        if path:
+            os.replace(path, full)
+        elif os.path.exists(full):
+            os.remove(full)
+        # Parts appended by exports made before the table was rewritten in full
+        for part in glob.glob(os.path.join(directory, "part-*-*.parquet")):
+            os.remove(part)
+        return count
+
+    def append(self, engine, table, directory):
+        # The last ID already exported is in the name of the last file (part-FIRST-LAST.parquet)
+        parts = sorted(glob.glob(os.path.join(directory, "part-*-*.parquet")))
+        exported = int(os.path.basename(parts[-1]).split(".")[0].split("-")[2]) if parts else 0
+
+        path, count, last_id = self.write(engine, table, select([table]).where(table.c.id > exported).order_by(table.c.id), directory)
+        if path:
+            os.replace(path, os.path.join(directory, "part-{:010d}-{:010d}.parquet".format(exported + 1, last_id)))
+        return count
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import time
+import sqlite3
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from rugby import models, database, aggregates
+
+class Command(ScrapyCommand):
+    """ Merges the DBs written by sharded crawls into the DB of the settings (SQLITE_ABS_PATH).
+
+    Each shard is attached to the main DB and copied with one INSERT ... SELECT per table, in one transaction :
+    - teams and players are de-duplicated by ID (player profiles are merged field by field, like the pipeline does)
+    - matches are de-duplicated by ID, and the stats and events of a match are only copied along with the match.
+    Merging the same shard twice is a no-op, and a failed merge leaves the main DB as it was before that shard.
+    The aggregate tables are rebuilt once all the shards are merged.
+    """
+
+    requires_project = True
+
+    def syntax(self):
+        return "SHARD_DB [SHARD_DB ...]"
+
+    def short_desc(self):
+        return "Merge the DBs of sharded crawls into the main DB"
+
+    def run(self, args, opts):
+        if not args:
+            raise UsageError()
+
+        # Make sure the main DB exists with an up to date schema
+        path = self.settings.get("SQLITE_ABS_PATH")
+        database.get_engine(self.settings).dispose()
+
+        connection = sqlite3.connect(path, isolation_level = None)
+        try:
+            for shard in args:
+                start = time.time()
+                counts = self.merge(connection, shard)
+                print("Merged {} in {:.1f}s : {}".format(shard, time.time() - start, ", ".join("{} {}".format(count, table) for table, count in counts.items())))
+        finally:
+            connection.close()
+
+        # The totals of the shards only cover their own matches
+        start = time.time()
+        engine = database.get_engine(self.settings)
+        with engine.begin() as connection:
+            counts = aggregates.rebuild(connection)
+        print("Rebuilt the totals in {:.1f}s : {}".format(time.time() - start, ", ".join("{} {}".format(count, table) for table, count in counts.items())))
+
+    def merge(self, connection, shard):
+        connection.execute("ATTACH DATABASE ? AS shard", (shard,))
+        try:
+            connection.execute("BEGIN")
+            try:
+                counts = self._copy(connection)
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            return counts
+        finally:
+            connection.execute("DETACH DATABASE shard")
+
+    def _columns(self, connection, table):
+        """ Columns of a table that exist in both DBs (shards may have been written with an older schema) """
+        shard_columns = {row[1] for row in connection.execute("PRAGMA shard.table_info({})".format(table.name))}
+        return [column.name for column in table.columns if column.name in shard_columns]
+
+    def _copy(self, connection):
+        counts = {}
+        changes = lambda: connection.execute("SELECT changes()").fetchone()[0]
+
+        # Matches of the shard that aren't in the main DB yet
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS new_matches (id INTEGER PRIMARY KEY)")
+        connection.execute("DELETE FROM new_matches")
+        connection.execute("INSERT INTO new_matches SELECT id FROM shard.matchs WHERE id NOT IN (SELECT id FROM main.matchs)")
+
+        for table in models.Base.metadata.sorted_tables:
+            columns = self._columns(connection, table)
+            if not columns or table.info.get("aggregate"):
+                continue
+            if table.name == models.Player.__tablename__ and sqlite3.sqlite_version_info >= (3, 24, 0):
+                # "WHERE true" lifts the parsing ambiguity between the join and the upsert clauses
+                updates = ["{0} = COALESCE(excluded.{0}, {1}.{0})".format(column, table.name) for column in columns if column != "id"]
+                statement = "INSERT INTO main.{0} ({1}) SELECT {1} FROM shard.{0} WHERE true ON CONFLICT (id) DO UPDATE SET {2}".format(table.name, ", ".join(columns), ", ".join(updates))
+            elif "match_id" in table.columns:
+                # Surrogate IDs of the child tables are left to the main DB
+                columns = [column for column in columns if column != "id"]
+                statement = "INSERT INTO main.{0} ({1}) SELECT {1} FROM shard.{0} WHERE match_id IN (SELECT id FROM new_matches)".format(table.name, ", ".join(columns))
+            elif table.name == models.Match.__tablename__:
+                statement = "INSERT INTO main.{0} ({1}) SELECT {1} FROM shard.{0} WHERE id IN (SELECT id FROM new_matches)".format(table.name, ", ".join(columns))
+            else:
+                statement = "INSERT OR IGNORE INTO main.{0} ({1}) SELECT {1} FROM shard.{0}".format(table.name, ", ".join(columns))
+            connection.execute(statement)
+            counts[table.name] = changes()
+        return counts
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from rugby import models
+from rugby.cache import IdSet
+
+def get_db_url(settings):
+    """ Returns DATABASE_URL if set, else the URL of the SQLite DB at SQLITE_ABS_PATH """
+    return settings.get("DATABASE_URL") or "sqlite:///" + settings.get("SQLITE_ABS_PATH")
+
+def get_engine(settings):
+    """ Returns an engine bound to the DB configured in the settings, with an up to date schema """
+    engine = create_engine(get_db_url(settings))
+    models.create_tables(engine)
+    return engine
+
+def get_ids(engine, model, *criterion):
+    """ Returns the primary keys of a table (optionally filtered) as an IdSet """
+    session = sessionmaker(bind = engine)()
+    try:
+        return IdSet(id for id, in session.query(model.id).filter(*criterion).yield_per(10000))
+    finally:
+        session.close()
+
+def get_latest_match_date(engine):
+    """ Returns the date of the most recent match stored in the DB, or None if there isn't any """
+    session = sessionmaker(bind = engine)()
+    try:
+        return session.query(func.max(models.Match.date)).scalar()
+    finally:
+        session.close()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+from collections import OrderedDict
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+logger = logging.getLogger(__name__)
+
+# CPU time of the reactor thread only, when available (Python 3.7+)
+cpu_time = getattr(time, "thread_time", time.process_time)
+
+class Timings(object):
+    """ Records wall-clock and CPU times in the stats collector, as totals and as a histogram of wall-clock times.
+    Each timed step also blocks the reactor, so the ones longer than the threshold are logged as stalls.
+    """
+
+    # Upper bounds (in seconds) of the histogram buckets
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self, stats, stall_threshold):
+        self.stats = stats
+        self.stall_threshold = stall_threshold
+
+    @classmethod
+    def from_settings(cls, settings, stats):
+        if not settings.getbool("PROFILER_ENABLED"):
+            raise NotConfigured
+        return cls(stats, settings.getfloat("PROFILER_STALL_THRESHOLD", 0.5))
+
+    def bucket(self, wall):
+        for bound in self.buckets:
+            if wall <= bound:
+                return "<={}ms".format(int(bound * 1000))
+        return ">{}ms".format(int(self.buckets[-1] * 1000))
+
+    def record(self, prefix, wall, cpu):
+        """ Records one call (a whole callback or pipeline call, made of one or more steps) """
+        self.stats.inc_value("{}/count".format(prefix))
+        self.stats.inc_value("{}/wall_total".format(prefix), wall)
+        self.stats.inc_value("{}/cpu_total".format(prefix), cpu)
+        self.stats.max_value("{}/wall_max".format(prefix), wall)
+        self.stats.inc_value("{}/wall/{}".format(prefix, self.bucket(wall)))
+
+    def step(self, prefix, wall, context):
+        """ Checks one uninterrupted run of code on the reactor thread """
+        if wall > self.stall_threshold:
+            self.stats.inc_value("{}/stalls".format(prefix))
+            self.stats.inc_value("profiler/stalls")
+            logger.warning("{} blocked the reactor for {:.3f}s on {}".format(prefix.split("/", 1)[1], wall, context))
+
+    def timed_iterator(self, prefix, iterable, url):
+        """ Times every step of a callback output : callbacks are generators, and the
+        reactor runs each next() call in one go """
+        wall_total, cpu_total = 0, 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                wall, cpu = time.perf_counter(), cpu_time()
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    wall, cpu = time.perf_counter() - wall, cpu_time() - cpu
+                    wall_total, cpu_total = wall_total + wall, cpu_total + cpu
+                    self.step(prefix, wall, url)
+                yield value
+        finally:
+            self.record(prefix, wall_total, cpu_total)
+
+    def timed_call(self, prefix, function, context):
+        def call(*args, **kwargs):
+            wall, cpu = time.perf_counter(), cpu_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                wall, cpu = time.perf_counter() - wall, cpu_time() - cpu
+                self.step(prefix, wall, context(*args))
+                self.record(prefix, wall, cpu)
+        return call
+
+def profiled(pipeline, crawler):
+    """ Times the process_item() calls of an item pipeline (see PROFILER_ENABLED). Pipelines wrap themselves in
+    from_crawler(), as Scrapy has no public hook around the calls of each pipeline. Returns the pipeline. """
+    try:
+        timings = Timings.from_settings(crawler.settings, crawler.stats)
+    except NotConfigured:
+        return pipeline
+    prefix = "profiler/pipeline/{}".format(type(pipeline).__name__)
+    pipeline.process_item = timings.timed_call(prefix, pipeline.process_item, lambda item, spider: type(item).__name__)
+    return pipeline
+
+class ProfilerMiddleware(object):
+    """ Spider middleware timing the spider callbacks (see PROFILER_ENABLED).
+    It must be the closest to the spider, so that other middlewares aren't counted.
+    """
+
+    def __init__(self, timings):
+        self.timings = timings
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(Timings.from_settings(crawler.settings, crawler.stats))
+
+    def process_spider_output(self, response, result, spider):
+        callback = response.request.callback if response.request else None
+        name = getattr(callback, "__name__", "parse")
+        return self.timings.timed_iterator("profiler/callback/{}".format(name), result, response.url)
+
+class Profiler(object):
+    """ Extension logging a summary of all the timings when the spider closes (see PROFILER_ENABLED).
+    Callbacks are timed by ProfilerMiddleware, and the item pipelines by profiled().
+    """
+
+    def __init__(self, crawler, timings):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.timings = timings
+        crawler.signals.connect(self.spider_closed, signal = signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler, Timings.from_settings(crawler.settings, crawler.stats))
+
+    def spider_closed(self, spider):
+        rows = OrderedDict()
+        for key, value in sorted(self.stats.get_stats().items()):
+            parts = key.split("/")
+            if parts[0] == "profiler" and len(parts) == 4 and parts[3] in ("count", "wall_total", "cpu_total", "wall_max", "stalls"):
+                rows.setdefault("/".join(parts[1:3]), {})[parts[3]] = value
+        if not rows:
+            return
+
+        lines = ["{:<45} {:>8} {:>10} {:>10} {:>10} {:>10} {:>7}".format("", "calls", "wall (s)", "mean (ms)", "max (ms)", "cpu (s)", "stalls")]
+        for name, row in sorted(rows.items(), key = lambda entry: -entry[1].get("wall_total", 0)):
+            count = row.get("count", 0)
+            lines.append("{:<45} {:>8} {:>10.3f} {:>10.3f} {:>10.1f} {:>10.3f} {:>7}".format(
+                name, count, row.get("wall_total", 0), 1000 * row.get("wall_total", 0) / max(count, 1),
+                1000 * row.get("wall_max", 0), row.get("cpu_total", 0), row.get("stalls", 0)))
+        spider.logger.info("Time spent on the reactor thread :\n" + "\n".join(lines))
@@ -74,6 +74,7 @@ class Player(Item):
     birthday = Field()
     height = Field()
     weight = Field()
+    fetched_at = Field()
 
 class PlayerStats(Item):
     """Data structure to store player stats per match"""
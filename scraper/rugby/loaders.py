@@ -43,6 +43,19 @@ def parse_height(string):
 def parse_stats(entry):
     return int(regex.sub("\D", "", str(entry)))
 
+# Stat cells holding one or several numbers and nothing else : "12", "3/1", "4/10/7" ...
+compound_re = regex.compile("^\\s*([0-9]+(?:/[0-9]+)*)\\s*$")
+
+def parse_compound(entry, size = 1):
+    """ Returns the numbers of a stat cell as a tuple of ints, or None if it doesn't hold exactly `size` numbers """
+    match = compound_re.match(str(entry))
+    if not match:
+        return None
+    numbers = match.group(1).split("/")
+    if len(numbers) != size:
+        return None
+    return tuple(int(number) for number in numbers)
+
 def parse_id(id):
     id = int(id)
     return id if id != 0 else None
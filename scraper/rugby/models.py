@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Enum, Text, SmallInteger, Float
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Enum, Text, SmallInteger, Float, UniqueConstraint, Index, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -8,7 +8,48 @@ Base = declarative_base()
 
 def create_tables(engine):
     """"""
-    return Base.metadata.create_all(engine)
+    Base.metadata.create_all(engine)
+    migrate(engine)
+
+def migrate(engine):
+    """ Brings the schema of an existing DB up to date with the models (create_all only creates missing tables) """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {tuple(sorted(constraint["column_names"])) for constraint in inspector.get_unique_constraints(table.name)}
+        existing |= {tuple(sorted(index["column_names"])) for index in inspector.get_indexes(table.name) if index["unique"]}
+        for constraint in table.constraints:
+            if not isinstance(constraint, UniqueConstraint):
+                continue
+            columns = [column.name for column in constraint.columns]
+            if tuple(sorted(columns)) in existing:
+                continue
+            # Entries written twice before the constraint existed : only the last one is kept
+            if "id" in table.columns:
+                engine.execute("DELETE FROM {0} WHERE id NOT IN (SELECT MAX(id) FROM {0} GROUP BY {1})".format(table.name, ", ".join(columns)))
+            # SQLite can't add a constraint to an existing table, a unique index does the same job
+            engine.execute("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})".format(constraint.name, table.name, ", ".join(columns)))
+
+        # New nullable columns, filled with their "backfill" SQL expression if they define one
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            engine.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table.name, column.name, column.type.compile(engine.dialect)))
+            if "backfill" in column.info:
+                engine.execute("UPDATE {} SET {} = {}".format(table.name, column.name, column.info["backfill"]))
+
+        # Lookup indexes added since the table was created, and the ones the models don't declare anymore (replaced
+        # by another index), that every write would still maintain. Tables in the compact layout (no id) are left alone.
+        indexes = inspector.get_indexes(table.name)
+        existing = {index["name"] for index in indexes}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+        declared = {index.name for index in table.indexes}
+        if "id" in {column["name"] for column in inspector.get_columns(table.name)}:
+            for index in indexes:
+                if not index["unique"] and index["name"] not in declared:
+                    engine.execute("DROP INDEX {}".format(index["name"]))
 
 class Team(Base):
     __tablename__ = "teams"
@@ -18,6 +59,11 @@ class Team(Base):
 
 class Match(Base):
     __tablename__ = "matchs"
+    __table_args__ = (
+        Index("ix_matchs_date", "date"),
+        Index("ix_matchs_home_team", "home_team_id", "date"),
+        Index("ix_matchs_away_team", "away_team_id", "date"),
+    )
 
     id = Column(Integer, primary_key = True)
     home_team_id = Column(Integer, ForeignKey("teams.id"), nullable = False)
@@ -38,9 +84,15 @@ class Player(Base):
     birthday = Column(DateTime, nullable = True)
     height = Column(Float, nullable = True)
     weight = Column(Integer, nullable = True)
+    # Date of the last profile page fetch (existing profiles are considered fresh when the column is added)
+    fetched_at = Column(DateTime, nullable = True, info = {"backfill": "CURRENT_TIMESTAMP"})
 
 class MatchStats(Base):
     __tablename__ = "matchstats"
+    __table_args__ = (
+        UniqueConstraint("match_id", "team_id", name = "uq_matchstats_match_team"),
+        Index("ix_matchstats_team", "team_id", "match_id"),
+    )
 
     id = Column(Integer, primary_key = True)
     match_id = Column(Integer, ForeignKey("matchs.id"), nullable = False)
@@ -56,6 +108,10 @@ class MatchStats(Base):
 
 class PlayerStats(Base):
     __tablename__ = "playerstats"
+    __table_args__ = (
+        UniqueConstraint("player_id", "team_id", "match_id", name = "uq_playerstats_player_team_match"),
+        Index("ix_playerstats_match", "match_id", "team_id"),
+    )
 
     id = Column(Integer, primary_key = True)
     player_id = Column(Integer, ForeignKey("players.id"), nullable = False)
@@ -63,7 +119,7 @@ class PlayerStats(Base):
     match_id = Column(Integer, ForeignKey("matchs.id"), nullable = False)
     position = Column(String(20), nullable = True)
     number = Column(Integer, nullable = True)
-    first_team = Column(Boolean, nullable = False)
+    first_team = Column(Boolean, nullable = False, default = False)
     tries = Column(Integer, nullable = True)
     cons = Column(Integer, nullable = True)
     pens = Column(Integer, nullable = True)
@@ -74,13 +130,17 @@ class PlayerStats(Base):
 
 class GameEvent(Base):
     __tablename__ = "events"
+    __table_args__ = (
+        Index("ix_events_match", "match_id", "team_id"),
+        Index("ix_events_player", "player_id", "match_id"),
+    )
 
     id = Column(Integer, primary_key = True)
     player_id = Column(Integer, ForeignKey("players.id"), nullable = False)
     team_id = Column(Integer, ForeignKey("teams.id"), nullable = False)
     match_id = Column(Integer, ForeignKey("matchs.id"), nullable = False)
     time = Column(Integer, nullable = False)
-    action_type = Column(Enum("tries", "cons", "pens", "drops"), nullable = False)
+    action_type = Column(Enum("tries", "cons", "pens", "drops", name = "action_type"), nullable = False)
     extra_info = Column(Text, nullable = True)
     player = relationship(Player)
     match = relationship(Match)
@@ -88,6 +148,10 @@ class GameEvent(Base):
 
 class MatchExtraStats(Base):
     __tablename__ = "matchextrastats"
+    __table_args__ = (
+        UniqueConstraint("match_id", "team_id", name = "uq_matchextrastats_match_team"),
+        Index("ix_matchextrastats_team", "team_id", "match_id"),
+    )
 
     id = Column(Integer, primary_key = True)
     match_id = Column(Integer, ForeignKey("matchs.id"), nullable = False)
@@ -120,6 +184,10 @@ class MatchExtraStats(Base):
 
 class PlayerExtraStats(Base):
     __tablename__ = "playerextrastats"
+    __table_args__ = (
+        UniqueConstraint("player_id", "team_id", "match_id", name = "uq_playerextrastats_player_team_match"),
+        Index("ix_playerextrastats_match", "match_id", "team_id"),
+    )
 
     id = Column(Integer, primary_key = True)
     player_id = Column(Integer, ForeignKey("players.id"), nullable = False)
@@ -146,3 +214,62 @@ class PlayerExtraStats(Base):
     player = relationship(Player)
     match = relationship(Match)
     team = relationship(Team)
+
+# Aggregate tables, maintained by the pipeline for the players and teams of each written batch
+# (see rugby/aggregates.py) and rebuilt from scratch by "scrapy aggregates"
+
+class PlayerTotals(Base):
+    __tablename__ = "playertotals"
+    __table_args__ = {"info": {"aggregate": True}}
+
+    player_id = Column(Integer, ForeignKey("players.id"), primary_key = True, autoincrement = False)
+    matches = Column(Integer, nullable = False)
+    first_team_matches = Column(Integer, nullable = False)
+    tries = Column(Integer, nullable = True)
+    cons = Column(Integer, nullable = True)
+    pens = Column(Integer, nullable = True)
+    drops = Column(Integer, nullable = True)
+    points = Column(Integer, nullable = True)
+    assists = Column(Integer, nullable = True)
+    kicks = Column(Integer, nullable = True)
+    passes = Column(Integer, nullable = True)
+    runs = Column(Integer, nullable = True)
+    meters = Column(Integer, nullable = True)
+    breaks = Column(Integer, nullable = True)
+    def_beaten = Column(Integer, nullable = True)
+    offloads = Column(Integer, nullable = True)
+    turnovers = Column(Integer, nullable = True)
+    tackles_made = Column(Integer, nullable = True)
+    tackles_missed = Column(Integer, nullable = True)
+    yellow_cards = Column(Integer, nullable = True)
+    red_cards = Column(Integer, nullable = True)
+    player = relationship(Player)
+
+class TeamSeasonTotals(Base):
+    __tablename__ = "teamseasontotals"
+    __table_args__ = {"info": {"aggregate": True}}
+
+    team_id = Column(Integer, ForeignKey("teams.id"), primary_key = True, autoincrement = False)
+    season = Column(Integer, primary_key = True, autoincrement = False)
+    matches = Column(Integer, nullable = False)
+    won = Column(Integer, nullable = False)
+    drawn = Column(Integer, nullable = False)
+    lost = Column(Integer, nullable = False)
+    scored = Column(Integer, nullable = False)
+    conceded = Column(Integer, nullable = False)
+    tries = Column(Integer, nullable = True)
+    cons = Column(Integer, nullable = True)
+    pens = Column(Integer, nullable = True)
+    drops = Column(Integer, nullable = True)
+    kicks = Column(Integer, nullable = True)
+    passes = Column(Integer, nullable = True)
+    runs = Column(Integer, nullable = True)
+    meters = Column(Integer, nullable = True)
+    breaks = Column(Integer, nullable = True)
+    offloads = Column(Integer, nullable = True)
+    turnovers = Column(Integer, nullable = True)
+    tackles_made = Column(Integer, nullable = True)
+    tackles_missed = Column(Integer, nullable = True)
+    yellow_cards = Column(Integer, nullable = True)
+    red_cards = Column(Integer, nullable = True)
+    team = relationship(Team)
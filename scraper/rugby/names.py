@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+
+class PlayerNameIndex(object):
+    """ Resolves the names used in score summaries and stats tabs ("Smith", "J Smith") to the ID of
+    a player of one team. Built once per team and match, so that each lookup is a couple of dict gets.
+
+    A name matches the players whose surname contains its last word. When several players match,
+    a name with an initial only keeps the players with this initial and exactly this surname.
+    """
+
+    def __init__(self, players):
+        """ players : dict of player id -> (name, position, number), as built from the "Teams" tab """
+        self.ids = list(players.keys())
+        # Every part of every surname -> players whose surname contains it
+        self.by_surname_part = defaultdict(list)
+        # (initial, surname) -> players
+        self.by_initial_surname = defaultdict(list)
+
+        for player_id, player_info in players.items():
+            tokens = player_info[0].upper().strip().split(" ")
+            surname = tokens[-1]
+            parts = {surname[i:j] for i in range(len(surname)) for j in range(i + 1, len(surname) + 1)}
+            for part in parts:
+                self.by_surname_part[part].append(player_id)
+            self.by_initial_surname[(tokens[0][:1], surname)].append(player_id)
+
+    def resolve(self, name):
+        """ Returns the ID of the player designated by name, raises RuntimeError if there is none or several """
+        tokens = name.upper().strip().split(" ")
+        potential = self.by_surname_part.get(tokens[-1], []) if tokens[-1] else self.ids
+        if len(potential) == 0:
+            raise RuntimeError("no name was detected")
+        elif len(potential) == 1:
+            return potential[0]
+        if len(tokens) == 1:
+            raise RuntimeError("two many names containing the exact researched name")
+
+        final = self.by_initial_surname.get((tokens[0][0], tokens[-1]), [])
+        if len(final) == 1:
+            return final[0]
+        raise RuntimeError("could not find name")
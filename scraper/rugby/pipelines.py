@@ -5,80 +5,298 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.engine.url import URL
+import io
+import os
+import csv
+import gzip
+import json
+import time
+import datetime
+from collections import defaultdict, deque
 
-from rugby import models, items, settings
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.misc import load_object
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.threadpool import ThreadPool
+
+from rugby import items
+from rugby.extensions import profiled
+
+# Optional dependency, only needed for zstd-compressed feeds
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class WriterThread(object):
+    """ Runs the DB calls of the pipeline one at a time in a dedicated thread, so that commits never block the
+    reactor. Calls return Deferreds fired in the reactor thread. Without a thread, calls run synchronously.
+    """
+
+    def __init__(self, threaded, queue_size):
+        self.queue_size = max(1, queue_size)
+        self.pending = deque()
+        self.pool = None
+        if threaded:
+            self.pool = ThreadPool(minthreads = 1, maxthreads = 1, name = "DBWriter")
+            self.pool.start()
+            self.shutdown_trigger = reactor.addSystemEventTrigger("during", "shutdown", self.pool.stop)
+
+    def call(self, function, *args):
+        if self.pool is None:
+            return defer.maybeDeferred(function, *args)
+        deferred = threads.deferToThreadPool(reactor, self.pool, function, *args)
+        self.pending.append(deferred)
+        deferred.addBoth(self._done, deferred)
+        return deferred
+
+    def _done(self, result, deferred):
+        self.pending.remove(deferred)
+        return result
+
+    def full(self):
+        return len(self.pending) >= self.queue_size
+
+    def wait(self, result = None):
+        """ Returns a Deferred firing with result once the oldest queued call is done (right away if none is queued) """
+        if not self.pending:
+            return defer.succeed(result)
+        deferred = defer.Deferred()
+        self.pending[0].addBoth(lambda outcome: (deferred.callback(result), outcome)[1])
+        return deferred
+
+    def stop(self):
+        if self.pool is not None:
+            reactor.removeSystemEventTrigger(self.shutdown_trigger)
+            self.pool.stop()
 
 class RugbyScraperPipeline(object):
-    def __init__(self):
+    def __init__(self, settings, stats):
         """"""
+        self.settings = settings
+        self.stats = stats
+        self.batch_size = max(1, settings.getint("PIPELINE_BATCH_SIZE", 1))
+        self.batch_interval = settings.getfloat("PIPELINE_BATCH_INTERVAL", 5)
+
+        # Write buffer, grouped by item class
+        self.buffer = defaultdict(list)
+        self.buffered = 0
+        self.last_flush = time.time()
+        self.flush_loop = None
+        self.tracer = None
+
         # Connect to DB
-        self.engine = create_engine(self._get_db_url())
-        self.session = sessionmaker(bind = self.engine)
-        models.create_tables(self.engine)
+        self.storage = load_object(settings.get("STORAGE_BACKEND", "rugby.storage.SQLiteStorage")).from_settings(settings, stats)
+        # Batches are written by a dedicated thread, at most PIPELINE_WRITER_QUEUE_SIZE of them waiting
+        self.writer = WriterThread(settings.getbool("PIPELINE_WRITER_THREAD", True), settings.getint("PIPELINE_WRITER_QUEUE_SIZE", 4))
 
-    def _get_db_url(self):
-        return "sqlite:///" + settings.SQLITE_ABS_PATH
+    @classmethod
+    def from_crawler(cls, crawler):
+        return profiled(cls(crawler.settings, crawler.stats), crawler)
 
     def open_spider(self, spider):
         self.logger = spider.logger
+        self.tracer = getattr(spider, "tracer", None)
 
-    def process_item(self, item, spider):
-        """"""
-        session = self.session()
-        instance = None
+        # Make sure a slow trickle of items still gets written regularly
+        if self.batch_size > 1 and self.batch_interval > 0:
+            self.flush_loop = task.LoopingCall(self._flush_if_stale)
+            self.flush_loop.start(self.batch_interval, now = False)
+
+        # The storage connection is opened in the thread that uses it
+        return self.writer.call(self.storage.open, self.logger)
+
+    @defer.inlineCallbacks
+    def close_spider(self, spider):
+        if self.flush_loop and self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush()
+        while self.writer.pending:
+            yield self.writer.wait()
         try:
-            if isinstance(item, items.Match):
-                self._unique_insert(session, models.Match, item)
-            elif isinstance(item, items.Player):
-                self._unique_insert(session, models.Player, item)
-            elif isinstance(item, items.Team):
-                self._unique_insert(session, models.Team, item)
-            elif isinstance(item, items.MatchStats):
-                self._insert_or_update(session, models.MatchStats, item, match_id=item["match_id"], team_id=item["team_id"])
-            elif isinstance(item, items.MatchExtraStats):
-                self._generic_insert(session, models.MatchExtraStats, item)
-            elif isinstance(item, items.PlayerStats):
-                self._insert_or_update(session, models.PlayerStats, item, player_id=item["player_id"], team_id=item["team_id"], match_id=item["match_id"])
-            elif isinstance(item, items.PlayerExtraStats):
-                self._generic_insert(session, models.PlayerExtraStats, item)
-            elif isinstance(item, items.GameEvent):
-                self._generic_insert(session, models.GameEvent, item)
-            session.commit()
-        except Exception as e:
-            session.rollback()
-            self.logger.error("Error while committing to DB : {}".format(e))
+            yield self.writer.call(self.storage.close)
         finally:
-            session.close()
+            self.writer.stop()
 
+    def process_item(self, item, spider):
+        """"""
+        if type(item) not in self.storage.tables:
+            return item
+
+        self.buffer[type(item)].append(dict(item))
+        self.buffered += 1
+
+        if self.buffered >= self.batch_size:
+            self.flush()
+        else:
+            self._flush_if_stale()
+
+        # Back-pressure : the item stays in the scraper until the writer catches up
+        if self.writer.full():
+            return self.writer.wait(item)
         return item
 
-    def _generic_insert(self, session, model, item):
-        if not model or not item:
-            return
-        self.logger.info("Inserting entry of type \"{}\" in DB".format(item.__class__.__name__))
-        return session.add(model(**item))
+    def _flush_if_stale(self):
+        if self.buffered and time.time() - self.last_flush >= self.batch_interval:
+            self.flush()
 
-    def _unique_insert(self, session, model, item):
-        if not model or not item:
-            return
-        instance = model(**item)
+    def flush(self):
+        """ Hands all the buffered items to the writer thread, to be written to the DB in a single transaction.
+        Returns a Deferred firing once they are written.
+        """
+        self.last_flush = time.time()
+        if not self.buffered:
+            return defer.succeed(None)
+
+        batch, size = self.buffer, self.buffered
+        self.buffer, self.buffered = defaultdict(list), 0
+
+        deferred = self.writer.call(self._write, batch, size)
+        deferred.addCallback(self._written, batch, size)
+        deferred.addErrback(lambda failure: self.logger.error("Error while writing to DB : {}".format(failure.getErrorMessage())))
+        return deferred
+
+    def _write(self, batch, size):
+        """ Writes a batch (in the writer thread). If it fails, items are written again one by one
+        so that a single bad item doesn't take down the others.
+        """
+        start = time.time()
+        if not self.storage.write(batch):
+            self.logger.warning("Batch of {} items rejected by the DB, retrying item by item ...".format(size))
+            # Parents first, so that the rows referenced by the foreign keys of the others are stored
+            for item_class in self.storage.tables:
+                for row in batch.get(item_class, ()):
+                    self.storage.write({item_class: [row]})
+        return start, time.time()
+
+    def _written(self, times, batch, size):
+        start, end = times
+        latency = end - start
+        if self.tracer:
+            self.tracer.written(self._match_ids(batch), start, end)
+
+        self.stats.inc_value("pipeline/flush/count")
+        self.stats.inc_value("pipeline/flush/items", size)
+        self.stats.max_value("pipeline/flush/max_size", size)
+        self.stats.inc_value("pipeline/flush/latency_total", latency)
+        self.stats.max_value("pipeline/flush/latency_max", latency)
+        self.logger.info("Flushed {} items to DB in {:.3f}s".format(size, latency))
+
+    def _match_ids(self, batch):
+        for item_class, rows in batch.items():
+            key = "id" if item_class is items.Match else "match_id"
+            for row in rows:
+                if key in row:
+                    yield row[key]
+
+class FeedFile(object):
+    """ Feed of one item class, written to a sequence of files : a new one is started once the current one
+    holds max_items items or max_bytes bytes (before compression, 0 for no limit). Files are written under
+    a ".part" name and renamed once complete, so that consumers only ever see complete files.
+    """
+
+    extensions = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+    def __init__(self, directory, name, format, fields, compression, max_bytes, max_items, buffer_size):
+        self.directory = directory
+        self.name = name
+        self.format = format
+        self.fields = fields
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.buffer_size = buffer_size
+        self.prefix = "{}-{}".format(name, datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"))
+        self.sequence = 0
+        self.file = None
+
+    def _open(self):
+        self.sequence += 1
+        self.path = os.path.join(self.directory, "{}-{:05d}.{}{}".format(self.prefix, self.sequence, self.format, self.extensions[self.compression]))
+        self.raw = open(self.path + ".part", "wb", buffering = self.buffer_size)
+        if self.compression == "gzip":
+            stream = gzip.GzipFile(fileobj = self.raw, mode = "wb", compresslevel = 6)
+        elif self.compression == "zstd":
+            stream = zstandard.ZstdCompressor().stream_writer(self.raw, closefd = False)
+        else:
+            stream = self.raw
+        self.file = io.TextIOWrapper(stream, encoding = "utf-8", newline = "", write_through = False)
+        self.bytes, self.items = 0, 0
+        if self.format == "csv":
+            self.writer = csv.DictWriter(self.file, fieldnames = self.fields, extrasaction = "ignore")
+            self.writer.writeheader()
 
-        if not session.query(model).filter(model.id == instance.id).first():
-            return self._generic_insert(session, model, item)
+    def write(self, row):
+        if self.file is None:
+            self._open()
+        if self.format == "csv":
+            self.writer.writerow(row)
+            # Close enough to the size of the CSV line for rotation purposes
+            self.bytes += sum(len(str(value)) + 1 for value in row.values())
         else:
-            self.logger.info("\"{}\" already existing in DB".format(item.__class__.__name__))
+            line = json.dumps(row, default = self._default) + "\n"
+            self.file.write(line)
+            self.bytes += len(line)
+        self.items += 1
+        if (self.max_items and self.items >= self.max_items) or (self.max_bytes and self.bytes >= self.max_bytes):
+            self.close()
+
+    def _default(self, value):
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        raise TypeError("{} is not JSON serializable".format(type(value).__name__))
 
-    def _insert_or_update(self, session, model, item, **filters):
-        if not model or not item:
+    def close(self):
+        if self.file is None:
             return
+        self.file.close()
+        if not self.raw.closed:
+            self.raw.close()
+        os.replace(self.path + ".part", self.path)
+        self.file = None
 
-        result = session.query(model).filter_by(**filters).first()
+class FeedSinkPipeline(object):
+    """ Writes every item class to its own stream of newline-delimited JSON or CSV files in FEED_SINK_DIR
+    (one sub-directory per item class). Works alone or next to RugbyScraperPipeline, and never touches the DB.
+    """
 
-        if not result:
-            return self._generic_insert(session, model, item)
-        else:
-            session.query(model).filter_by(**filters).update(item)
-            self.logger.info("Updating \"{}\" item.".format(item.__class__.__name__))
+    def __init__(self, settings, stats):
+        """"""
+        self.directory = settings.get("FEED_SINK_DIR")
+        if not self.directory:
+            raise NotConfigured
+        self.format = settings.get("FEED_SINK_FORMAT", "jsonl")
+        self.compression = settings.get("FEED_SINK_COMPRESSION") or None
+        if self.format not in ("jsonl", "csv"):
+            raise ValueError("Unknown FEED_SINK_FORMAT \"{}\" (jsonl or csv)".format(self.format))
+        if self.compression not in FeedFile.extensions:
+            raise ValueError("Unknown FEED_SINK_COMPRESSION \"{}\" (gzip or zstd)".format(self.compression))
+        if self.compression == "zstd" and zstandard is None:
+            raise NotConfigured("zstd compression needs the zstandard package")
+        self.max_bytes = settings.getint("FEED_SINK_MAX_BYTES", 0)
+        self.max_items = settings.getint("FEED_SINK_MAX_ITEMS", 0)
+        self.buffer_size = settings.getint("FEED_SINK_BUFFER_SIZE", io.DEFAULT_BUFFER_SIZE)
+        self.stats = stats
+        self.feeds = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return profiled(cls(crawler.settings, crawler.stats), crawler)
+
+    def close_spider(self, spider):
+        for feed in self.feeds.values():
+            feed.close()
+
+    def process_item(self, item, spider):
+        """"""
+        item_class = type(item)
+        if item_class not in self.feeds:
+            name = item_class.__name__.lower()
+            directory = os.path.join(self.directory, name)
+            os.makedirs(directory, exist_ok = True)
+            self.feeds[item_class] = FeedFile(directory, name, self.format, list(item_class.fields.keys()),
+                self.compression, self.max_bytes, self.max_items, self.buffer_size)
+
+        self.feeds[item_class].write(dict(item))
+        self.stats.inc_value("feeds/items/{}".format(item_class.__name__.lower()))
+        return item
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+""" Read API of the DB for analysis : the results are NumPy structured arrays (one field per column), or dicts of
+column arrays with as_dict = True, fetched in a single query and converted column by column.
+
+    >>> from rugby.query import Reader
+    >>> reader = Reader("sqlite:////tmp/rugby_data.db")
+    >>> series = reader.player_matches(player_id)
+    >>> series["meters"].mean(), series["date"][-1]
+
+Results are kept in an LRU cache, dropped as soon as the DB changes (SQLite "data_version", PostgreSQL WAL position),
+so repeated queries don't hit the DB. The cached arrays are read-only, copy them to modify them. Integer stats that
+can be NULL are returned as floats, NULL being NaN.
+"""
+
+import inspect
+import functools
+from collections import OrderedDict
+
+from sqlalchemy import create_engine, select, case, or_, and_, func, Integer, Boolean, Float, DateTime
+from sqlalchemy.engine import Engine
+
+from rugby import models, database, aggregates
+
+# Optional dependency, only needed for the read API
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _dtype(column):
+    """ NumPy type of a result column """
+    if isinstance(column.type, DateTime):
+        return "datetime64[s]"
+    if isinstance(column.type, Boolean):
+        return "?"
+    if isinstance(column.type, Float):
+        return "f8"
+    if isinstance(column.type, Integer):
+        # NULL has no integer representation (labels take the nullability of the labeled column)
+        return "i8" if getattr(getattr(column, "element", column), "nullable", True) is False else "f8"
+    return "O"
+
+def _key(value):
+    """ Hashable version of a query argument """
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(sorted(value)) if isinstance(value, (set, frozenset)) else tuple(value)
+    return value
+
+def cached(method):
+    """ Memoizes a query method of Reader in its LRU cache, and handles its as_dict argument """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        as_dict = kwargs.pop("as_dict", False)
+        # Positional, keyword and default arguments give the same key
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (method.__name__,) + tuple((name, _key(value)) for name, value in bound.arguments.items() if name != "self")
+        result = self._cache_get(key)
+        if result is None:
+            result = method(self, *args, **kwargs)
+            self._cache_put(key, result)
+        if as_dict:
+            return OrderedDict((name, result[name]) for name in result.dtype.names)
+        return result
+    return wrapper
+
+class Reader(object):
+    """ Cached queries on a DB (URL or engine) """
+
+    def __init__(self, db, cache_size = 128):
+        if numpy is None:
+            raise ImportError("The read API needs numpy : pip install numpy")
+        self.engine = db if isinstance(db, Engine) else create_engine(db)
+        self.connection = self.engine.connect()
+        if self.engine.dialect.name == "postgresql":
+            # Don't leave a transaction open between queries
+            self.connection = self.connection.execution_options(isolation_level = "AUTOCOMMIT")
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.version = None
+        self.hits = self.misses = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(database.get_engine(settings), settings.getint("QUERY_CACHE_SIZE", 128))
+
+    def close(self):
+        self.connection.close()
+        self.cache.clear()
+
+    def clear(self):
+        """ Empties the cache """
+        self.cache.clear()
+
+    def data_version(self):
+        """ Value that changes whenever the DB is written to (by another connection), or None if it can't be known """
+        dialect = self.engine.dialect.name
+        if dialect == "sqlite":
+            return self.connection.execute("PRAGMA data_version").scalar()
+        if dialect == "postgresql":
+            # Any write to the cluster invalidates the cache, not only writes to this DB
+            return self.connection.execute("SELECT pg_current_wal_lsn()").scalar()
+        return None
+
+    def _cache_get(self, key):
+        version = self.data_version()
+        if version is None or version != self.version:
+            self.cache.clear()
+            self.version = version
+        result = self.cache.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        return result
+
+    def _cache_put(self, key, result):
+        if self.cache_size <= 0:
+            return
+        result.flags.writeable = False
+        self.cache[key] = result
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+
+    def fetch(self, query, types = None, **params):
+        """ Runs a query and returns its rows as a structured array. The NumPy type of each column is taken from the
+        query, or from types (column name -> type) for the computed columns. """
+        types = types or {}
+        dtype = [(column.name, types.get(column.name) or _dtype(column)) for column in query.columns]
+        rows = self.connection.execute(query, **params).fetchall()
+        result = numpy.empty(len(rows), dtype = dtype)
+        for (name, type), values in zip(dtype, zip(*rows)):
+            result[name] = numpy.array(values, dtype = type)
+        return result
+
+    @cached
+    def player_matches(self, player_id):
+        """ Match series of a player, by date : match, team and opponent, position and number, and the stats of the
+        player in the match (playerstats and playerextrastats) """
+        matchs, stats, extra = models.Match.__table__, models.PlayerStats.__table__, models.PlayerExtraStats.__table__
+        opponent = case([(matchs.c.home_team_id == stats.c.team_id, matchs.c.away_team_id)], else_ = matchs.c.home_team_id)
+        query = select(
+            [stats.c.match_id, matchs.c.date, matchs.c.match_type, stats.c.team_id,
+            opponent.label("opponent_id"), stats.c.position, stats.c.number, stats.c.first_team] +
+            [stats.c[name] for name in aggregates.PLAYER_STATS] +
+            [extra.c[name] for name in aggregates.PLAYER_EXTRA_STATS]
+        ).select_from(
+            stats.join(matchs, matchs.c.id == stats.c.match_id).outerjoin(extra, and_(
+                extra.c.match_id == stats.c.match_id, extra.c.team_id == stats.c.team_id, extra.c.player_id == stats.c.player_id))
+        ).where(stats.c.player_id == player_id).order_by(matchs.c.date, stats.c.match_id)
+        return self.fetch(query, {"opponent_id": "i8"})
+
+    @cached
+    def head_to_head(self, team_id, opponent_id):
+        """ Matches between two teams, by date, with the stats (matchstats) of both from the point of view of the first one """
+        matchs, stats = models.Match.__table__, models.MatchStats.__table__
+        own, other = stats.alias("own"), stats.alias("other")
+        query = select(
+            [matchs.c.id.label("match_id"), matchs.c.date, matchs.c.match_type, matchs.c.ground_id,
+            (matchs.c.home_team_id == team_id).label("home"), own.c.scored, own.c.conceded] +
+            [own.c[name] for name in ["tries", "cons", "pens", "drops"]] +
+            [other.c[name].label("opponent_" + name) for name in ["tries", "cons", "pens", "drops"]]
+        ).select_from(
+            matchs.join(own, and_(own.c.match_id == matchs.c.id, own.c.team_id == team_id))
+            .join(other, and_(other.c.match_id == matchs.c.id, other.c.team_id == opponent_id))
+        ).where(or_(
+            and_(matchs.c.home_team_id == team_id, matchs.c.away_team_id == opponent_id),
+            and_(matchs.c.home_team_id == opponent_id, matchs.c.away_team_id == team_id),
+        )).order_by(matchs.c.date, matchs.c.id)
+        return self.fetch(query)
+
+    @cached
+    def player_totals(self, player_ids):
+        """ Career totals of players (playertotals), by player ID """
+        totals, players = models.PlayerTotals.__table__, models.Player.__table__
+        query = select([totals.c.player_id, players.c.name] + [column for column in totals.columns if column.name != "player_id"]).select_from(
+            totals.join(players, players.c.id == totals.c.player_id)
+        ).where(totals.c.player_id.in_(list(player_ids))).order_by(totals.c.player_id)
+        return self.fetch(query)
+
+    @cached
+    def team_stats(self, seasons = None):
+        """ Totals of every team (teamseasontotals), over the given seasons or all of them, by team ID """
+        totals = models.TeamSeasonTotals.__table__
+        names = [column.name for column in totals.columns if column.name not in ("team_id", "season")]
+        query = select([totals.c.team_id] + [func.sum(totals.c[name]).label(name) for name in names]).group_by(totals.c.team_id).order_by(totals.c.team_id)
+        if seasons is not None:
+            query = query.where(totals.c.season.in_(list(seasons)))
+        # Sums of the NOT NULL columns are never NULL
+        return self.fetch(query, {name: "i8" for name in names if not totals.c[name].nullable})
+
+    def team_stat_matrix(self, columns, seasons = None, per_match = True):
+        """ Stats of every team as a matrix (teams x columns), per match or in total, over the given seasons or all
+        of them. Returns the team IDs (rows of the matrix) and the matrix. """
+        stats = self.team_stats(seasons)
+        matrix = numpy.column_stack([stats[name].astype("f8") for name in columns]) if len(columns) else numpy.empty((len(stats), 0))
+        if per_match:
+            matrix = matrix / stats["matches"][:, numpy.newaxis]
+        return stats["team_id"], matrix
@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import regex
+import datetime
 from urllib.parse import urljoin
 from collections import defaultdict, OrderedDict
 
 from scrapy import Request
 from scrapy.spiders import Spider
-from scrapy.exceptions import CloseSpider
 
+from rugby import models, database
+from rugby.cache import IdSet
+from rugby.names import PlayerNameIndex
+from rugby.tracing import MatchTracer, traced
 from rugby.items import Match, MatchStats, Team, Player, PlayerStats, GameEvent, MatchExtraStats, PlayerExtraStats
+from rugby.loaders import parse_compound, missing_values
 from rugby.loaders import MatchLoader, MatchStatsLoader, TeamLoader, PlayerLoader, PlayerStatsLoader, GameEventLoader, MatchExtraStatsLoader, PlayerExtraStatsLoader
 
 class ESPN(Spider):
@@ -20,7 +25,22 @@ class ESPN(Spider):
 
     # Custom params
     follow_pages = True
+    incremental = False # Only crawl matches more recent than the ones in the DB (-a incremental=1)
     categories = [1, 3]
+    span_min = datetime.date(1992, 7, 24)
+    span_max = None
+    # Shard of the history to crawl, so that several processes (each with its own DB) can split it :
+    # -a date_from=YYYY-MM-DD -a date_to=YYYY-MM-DD and/or -a pages=FIRST-LAST (all categories)
+    # or -a pages=CATEGORY:FIRST-LAST,CATEGORY:FIRST-LAST (the other categories are skipped)
+    date_from = None
+    date_to = None
+    pages = None
+    page_ranges = None
+    known_matches = None
+    fresh_players = None
+    requested_players = None # Players whose profile was already requested in this crawl
+    tracer = None # Per-match latency traces (see TRACE_FILE)
+    parse_pool = None # Worker processes parsing the match iframes (see PARSE_WORKERS)
     start_domain = "http://stats.espnscrum.com/"
     search_path = "/statsguru/rugby/stats/index.html"
 
@@ -31,6 +51,83 @@ class ESPN(Spider):
         "view": "match",
     }
 
+    # Match list fields found in the side menu div of each result row
+    match_link_fields = {
+        'id': 'li:nth-child(6) > a::attr(href)',
+        'home_team_id': 'li:nth-child(3) > a::attr(href)',
+        'away_team_id': 'li:nth-child(4) > a::attr(href)',
+        'ground_id': 'li:nth-child(5) > a::attr(href)',
+    }
+
+    # Columns of the "{team} stats" tabs : fields filled from the cell, default position, header pattern
+    player_stats_columns = [
+        (("name",), 2, regex.compile("player|name", regex.I)),
+        (("tries", "assists"), 3, regex.compile("tries", regex.I)),
+        (("points",), 4, regex.compile("points|pts", regex.I)),
+        (("kicks", "passes", "runs"), 5, regex.compile("kicks", regex.I)),
+        (("meters",), 6, regex.compile("met(re|er)s", regex.I)),
+        (("breaks",), 7, regex.compile("breaks", regex.I)),
+        (("def_beaten",), 8, regex.compile("defenders|beaten", regex.I)),
+        (("offloads",), 9, regex.compile("offloads", regex.I)),
+        (("turnovers",), 10, regex.compile("turnovers", regex.I)),
+        (("tackles_made", "tackles_missed"), 11, regex.compile("tackles", regex.I)),
+        (("lineouts_won_on_throw", "lineouts_stolen_from_opp"), 12, regex.compile("lineouts", regex.I)),
+        (("pens_conceded",), 13, regex.compile("penalties|pens", regex.I)),
+        (("yellow_cards", "red_cards"), 14, regex.compile("cards", regex.I)),
+    ]
+
+    # Pattern of the stat cells holding a single number
+    single_number = regex.compile("^\\s*([0-9]+)\\s*$")
+
+    # Rows of the "Match stats" tab, by title : pattern of the cell values, fields filled from the
+    # numbers it captures, and an optional function computing the field values from these numbers
+    match_stats_registry = {
+        "Penalty goals": (regex.compile("[0-9]+ from ([0-9]+)"), ("pens_attempt",), None),
+        "Dropped goals": (regex.compile("([0-9]+)(?: \\(([0-9]+) missed\\))?"), ("drops_attempt",), lambda scored, missed: (scored + (missed or 0),)),
+        "Kicks from hand": (single_number, ("kicks",), None),
+        "Passes": (single_number, ("passes",), None),
+        "Runs": (single_number, ("runs",), None),
+        "Metres run with ball": (single_number, ("meters",), None),
+        "Clean breaks": (single_number, ("breaks",), None),
+        "Defenders beaten": (single_number, ("def_beaten",), None),
+        "Offloads": (single_number, ("offloads",), None),
+        "Turnovers conceded": (single_number, ("turnovers",), None),
+        "Penalties conceded": (single_number, ("pens_conceded",), None),
+        "Rucks won": (regex.compile("^\\n([0-9]+) from ([0-9]+)"), ("rucks_won", "rucks_init"), None),
+        "Mauls won": (regex.compile("^\\n([0-9]+) from ([0-9]+)"), ("mall_won", "mall_init"), None),
+        "Tackles made/missed": (regex.compile("^([0-9]+)/([0-9]+)$"), ("tackles_made", "tackles_missed"), None),
+        "Scrums on own feed": (regex.compile("^\\n\\t  ([0-9]+) won, ([0-9]+) lost"), ("scrums_won_on_feed", "scrums_lost_on_feed"), None),
+        "Lineouts on own throw": (regex.compile("^\\n\\t  ([0-9]+) won, ([0-9]+) lost"), ("lineouts_won_on_throw", "lineouts_lost_on_throw"), None),
+        "Yellow/red cards": (regex.compile("^([0-9]+)/([0-9]+)$"), ("yellow_cards", "red_cards"), None),
+    }
+
+    # Match list fields found in the result row itself
+    match_row_fields = {
+        "won": "td:nth-child(2)::text",
+        "date": "td:nth-child(13) b::text"
+    }
+
+    def __init__(self, *args, **kwargs):
+        super(ESPN, self).__init__(*args, **kwargs)
+        # Pagination state per category : next page to request, and last page worth requesting (None until known)
+        self.next_page = {}
+        self.stop_page = {}
+        # URL pattern of the match iframes, learnt from the first match page if not configured
+        self.iframe_template = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(ESPN, cls).from_crawler(crawler, *args, **kwargs)
+        spider.tracer = MatchTracer.from_crawler(crawler)
+        # The workers run this spider's parser, so they can only be imported once it is defined
+        from rugby.workers import ParsePool
+        spider.parse_pool = ParsePool.from_settings(crawler.settings)
+        return spider
+
+    def closed(self, reason):
+        if self.parse_pool:
+            self.parse_pool.close()
+
     def _generate_query_params(self, home_or_away = 1, page = 1):
         search_params = OrderedDict([
             ("class", 1), # ?,
@@ -39,7 +136,8 @@ class ESPN(Spider):
             ("orderbyad", "reverse"),
             ("page", page),
             ("size", 100), # Results per page
-            ("spanmin1", "24+Jul+1992"), # Lower bound date
+            ("spanmin1", self._format_date(self.span_min)), # Lower bound date
+            ("spanmax1", self._format_date(self.span_max) if self.span_max else None), # Upper bound date
             ("spanval1", "span"), # ?
             ("template", "results"),
             ("type", "team"),
@@ -47,9 +145,12 @@ class ESPN(Spider):
         ])
         return search_params
 
+    def _format_date(self, date):
+        return "{}+{}".format(date.day, date.strftime("%b+%Y"))
+
     def _generate_query_string(self, query_params):
         sep = ";"
-        key_values = ["{}={}".format(k, v) for k, v in query_params.items()]
+        key_values = ["{}={}".format(k, v) for k, v in query_params.items() if v is not None]
         return sep.join(key_values)
 
     def _generate_url(self, domain, path, query_params):
@@ -73,63 +174,150 @@ class ESPN(Spider):
         - ordered by date
         - grouped by home or away
         """
+        if str(self.incremental).lower() in ["1", "true", "yes"]:
+            self._setup_incremental()
+        self._setup_shard()
+        self._load_fresh_players()
+        self.requested_players = IdSet()
+        self.iframe_template = self.iframe_template or self.settings.get("IFRAME_URL_TEMPLATE")
+
         # Go !
-        page = 1
         for category in self.categories:
+            first, last = self.page_ranges.get(category, (1, None)) if self.page_ranges else (1, None)
+            if last is not None:
+                self._stop_paging(category, last)
+            self.next_page[category] = first
+            for request in self._fill_prefetch_window(category, current_page = first - 1):
+                yield request
+
+    def _setup_shard(self):
+        """ Restricts the crawl to the date window and page ranges given as spider arguments """
+        if self.date_from:
+            # The incremental watermark wins if it is more recent
+            self.span_min = max(self.span_min, datetime.datetime.strptime(self.date_from, "%Y-%m-%d").date())
+        if self.date_to:
+            self.span_max = datetime.datetime.strptime(self.date_to, "%Y-%m-%d").date()
+
+        if self.pages:
+            self.page_ranges = {}
+            for spec in str(self.pages).split(","):
+                category, pages = spec.split(":") if ":" in spec else (None, spec)
+                first, last = pages.split("-") if "-" in pages else (pages, pages)
+                page_range = (int(first or 1), int(last) if last else None)
+                for category in [int(category)] if category else self.categories:
+                    self.page_ranges[category] = page_range
+            # Categories without a range are left to other shards
+            self.categories = [category for category in self.categories if category in self.page_ranges]
+
+        if self.date_from or self.date_to or self.pages:
+            self.logger.info("Crawling the shard from {} to {}, pages {}".format(self.span_min, self.span_max or "today", self.pages or "all"))
+
+    def _fill_prefetch_window(self, category, current_page):
+        """ Keeps the PAGE_PREFETCH pages following the current one in flight, without going past the last page """
+        window = max(1, self.settings.getint("PAGE_PREFETCH", 1)) if self.follow_pages else 1
+        while self.next_page[category] <= current_page + window:
+            page = self.next_page[category]
+            if self.stop_page.get(category) is not None and page > self.stop_page[category]:
+                return
+            self.next_page[category] += 1
             self.logger.info("Scraping page {} - {} matches".format(page, "Home" if category == 1 else "Neutral"))
             yield self._generate_search_request(page = page, home_or_away = category)
 
+    def _stop_paging(self, category, page):
+        """ Marks the given page as the last one to scrape for a category """
+        if self.stop_page.get(category) is None or page < self.stop_page[category]:
+            self.stop_page[category] = page
+
+    def _setup_incremental(self):
+        """ Starts the search from the date of the most recent match in the DB (the "watermark"),
+        and remembers the stored matches so that paging can stop once only known matches show up.
+        """
+        engine = database.get_engine(self.settings)
+        try:
+            latest = database.get_latest_match_date(engine)
+            if not latest:
+                self.logger.info("No match in DB, running a full crawl")
+                return
+            self.span_min = latest.date()
+            self.known_matches = database.get_ids(engine, models.Match)
+        finally:
+            engine.dispose()
+        self.logger.info("Incremental crawl from {} ({} matches already in DB)".format(self.span_min, len(self.known_matches)))
+
+    def _load_fresh_players(self):
+        """ Loads the players whose profile was fetched less than PLAYER_PROFILE_TTL days ago,
+        their profile pages won't be requested again.
+        """
+        ttl = self.settings.getfloat("PLAYER_PROFILE_TTL", 0)
+        if ttl <= 0:
+            return
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days = ttl)
+        engine = database.get_engine(self.settings)
+        try:
+            self.fresh_players = database.get_ids(engine, models.Player, models.Player.fetched_at >= cutoff)
+        finally:
+            engine.dispose()
+        self.logger.info("{} player profiles fetched in the last {} days won't be fetched again".format(len(self.fresh_players), ttl))
+
+    def _player_request(self, response, player_info):
+        """ Returns the request to the player page, or None if we already have a fresh profile for this player
+        (counted as skipped) or already requested it in this crawl (counted as duplicate) """
+        # Player IDs are scraped as strings
+        player_id = int(player_info["id"])
+        if self.fresh_players is not None and player_id in self.fresh_players:
+            self.crawler.stats.inc_value("espn/player_profile/skipped")
+            return None
+        # Scrapy would filter the next requests anyway, but this saves building them
+        if self.requested_players is not None:
+            if player_id in self.requested_players:
+                self.crawler.stats.inc_value("espn/player_profile/duplicate")
+                return None
+            self.requested_players.add(player_id)
+        self.crawler.stats.inc_value("espn/player_profile/requested")
+        return response.follow(
+            url = "/statsguru/rugby/player/{}.html".format(player_info["id"]),
+            callback = self.player_info_parse,
+            meta = { "player_info" : player_info }
+        )
+
     def match_list_parse(self, response):
         """ Callback that handles the parsing and processing of the match list table.
         Returns : Match() item, MatchStats() item, Team() item
         """
 
+        category = int(response.meta["home_or_away"])
+        page = int(response.meta["page"])
+
+        # Pages requested ahead of time beyond the last one are simply dropped
+        if self.stop_page.get(category) is not None and page > self.stop_page[category]:
+            self.crawler.stats.inc_value("espn/pagination/ignored_pages")
+            return
+
         # Check if there are matches left to parse on the page.
         rows = response.css("tr.data1")
         if len(rows) == 1:
             msg = rows[0].css("td b::text").extract_first()
             if msg and "No records" in msg.strip():
-                self.logger.info("Finished scraping for category \"{}\" !".format("Home" if response.meta["home_or_away"] == 1 else "Neutral"))
-                self.categories.remove(int(response.meta["home_or_away"]))
-
-        # If we've finished the scraping for all categories, we can close the spider
-        if len(self.categories) == 0:
-            self.logger.info("All categories have been scraped ! Closing spider ...")
-            raise CloseSpider
-
-        id_fields = {
-            'id': 'li:nth-child(6) > a::attr(href)',
-            'home_team_id': 'li:nth-child(3) > a::attr(href)',
-            'away_team_id': 'li:nth-child(4) > a::attr(href)',
-            'ground_id': 'li:nth-child(5) > a::attr(href)',
-        }
-
-        meta_fields = {
-            "won": "td:nth-child(2)::text",
-            "date": "td:nth-child(13) b::text"
-        }
-
-        # Variable storing the index offset between the side menu divs and the rows
-        offset = None
+                self.logger.info("Finished scraping for category \"{}\" !".format("Home" if category == 1 else "Neutral"))
+                self._stop_paging(category, page - 1)
+                return
 
-        for index, links in enumerate(response.css(".engine-dd")):
-            if links.css("[id^=\"engine-dd-\"]"):
-                # Skip the UI divs
-                continue
+        # The side menu divs holding the links of each row come in the same order as the rows.
+        # Both lists are walked once and paired by position (the UI divs are skipped).
+        link_blocks = [links for links in response.css(".engine-dd") if not links.css("[id^=\"engine-dd-\"]")]
 
-            if not offset:
-                offset = index - 1
+        # IDs of the matches listed on this page
+        page_ids = []
 
+        for row, links in zip(rows, link_blocks):
             # 1) Extract the basic match info into the Match structure
-            loader = MatchLoader(item = Match(), response = response)
-            # Subloader that handles the links in the side menu divs
-            link_block_loader = loader.nested_css("#engine-dd{}".format(index - offset))
-            for field, selector in id_fields.items():
-                link_block_loader.add_css(field, selector, re = "\/([0-9]+)\.")
-            # Subloader that handles the match info in the table rows (won, date)
-            table_row_loader = loader.nested_css("tr.data1:nth-child({})".format(index - offset))
-            for field, selector in meta_fields.items():
-                table_row_loader.add_css(field, selector)
+            loader = MatchLoader(item = Match())
+            # Links in the side menu div
+            for field, selector in self.match_link_fields.items():
+                loader.add_value(field, links.css(selector).re("\/([0-9]+)\."))
+            # Match info in the table row (won, date)
+            for field, selector in self.match_row_fields.items():
+                loader.add_value(field, row.css(selector).extract())
             # Computed values
             loader.add_value("match_type", response.meta["home_or_away"])
             # Fetch the data
@@ -140,20 +328,24 @@ class ESPN(Spider):
                 self.logger.error("Missing IDs for match. Skipping ...")
                 continue
             self.logger.info("Found match ! ID : {}".format(match["id"]))
+            page_ids.append(match["id"])
 
-            yield response.follow(
-                url = "/statsguru/rugby/match/{}.html".format(match["id"]),
-                callback = self.match_page_parse,
-                meta = { "match" : match }
-            )
+            if self.known_matches is not None and match["id"] in self.known_matches:
+                self.crawler.stats.inc_value("espn/incremental/known_matches")
+                continue
 
-        # Get next page link and follow it if there is still data to process
+            yield self._match_request(match)
+
+        # Results are sorted by date, so a page with only known matches means that the rest has already been scraped
+        if self.known_matches is not None and page_ids and all(id in self.known_matches for id in page_ids):
+            self.logger.info("Only known matches on page {}, finished scraping for category \"{}\" !".format(page, "Home" if category == 1 else "Neutral"))
+            self._stop_paging(category, page)
+
+        # Keep the next pages coming if there is still data to process
         if self.follow_pages:
-            category = int(response.meta["home_or_away"])
-            if category in self.categories:
-                page = int(response.meta["page"]) + 1
-                self.logger.info("Scraping page {} - {} matches".format(page, "Home" if category == 1 else "Neutral"))
-                yield self._generate_search_request(page = page, home_or_away=category)
+            self.next_page.setdefault(category, page + 1)
+            for request in self._fill_prefetch_window(category, current_page = page):
+                yield request
 
     def player_info_parse(self, response):
         """ Callback that handles the parsing of the player info page (followed by the match iframe callback)
@@ -170,6 +362,7 @@ class ESPN(Spider):
         infos = response.css("#scrumPlayerContent table .scrumPlayerDesc")
         if infos:
             loader = PlayerLoader(item = response.meta["player_info"], response = response)
+            loader.add_value("fetched_at", datetime.datetime.utcnow())
             for info in infos:
                 title = info.xpath("b/text()").extract_first()
                 if title and title in fields.keys():
@@ -179,6 +372,41 @@ class ESPN(Spider):
             yield loader.load_item()
 
 
+    def _traced_meta(self, meta, stage):
+        """ Adds the trace of the next request of a match to its meta, when tracing is enabled """
+        if self.tracer:
+            meta["trace"] = self.tracer.request(meta["match"]["id"], stage)
+        return meta
+
+    def _match_request(self, match):
+        """ Returns the request to the match iframe if its URL pattern is known, otherwise to the match page """
+        if self.tracer:
+            self.tracer.discovered(match["id"])
+        if not self.iframe_template:
+            return self._match_page_request(match)
+        return Request(
+            url = self.iframe_template.format(id = match["id"]),
+            callback = self._match_iframe_direct_parse,
+            errback = self._match_iframe_direct_failed,
+            meta = self._traced_meta({ "match" : match }, "iframe")
+        )
+
+    def _match_page_request(self, match, fallback = False):
+        return Request(
+            url = urljoin(self.start_domain, "/statsguru/rugby/match/{}.html".format(match["id"])),
+            callback = self.match_page_parse,
+            meta = self._traced_meta({ "match" : match, "iframe_fallback": fallback }, "match_page")
+        )
+
+    def _learn_iframe_template(self, url, match_id):
+        """ Derives the iframe URL pattern from an iframe URL containing the match ID exactly once """
+        url = url.replace("{", "{{").replace("}", "}}")
+        template, count = regex.subn("(?<![0-9]){}(?![0-9])".format(match_id), "{id}", url)
+        if count == 1:
+            self.iframe_template = template
+            self.logger.info("Match iframes will be fetched directly from \"{}\"".format(template))
+
+    @traced
     def match_page_parse(self, response):
         """ Callback that acts as a buffer between the match links followed by the match list parser and
         the real processing. Checks that data is available in iframe.
@@ -187,51 +415,34 @@ class ESPN(Spider):
         iframe = response.css("#win_old::attr(src)").extract_first()
 
         if iframe:
+            self.crawler.stats.inc_value("espn/iframe/two_hop")
+            if not self.iframe_template:
+                self._learn_iframe_template(response.urljoin(iframe), response.meta["match"]["id"])
             yield response.follow(
                 url = iframe,
-                callback = self._match_iframe_parse,
-                meta = response.meta
+                callback = self._match_iframe_callback,
+                meta = self._traced_meta(dict(response.meta), "iframe"),
+                # The direct fetch of the same iframe may have been filtered already
+                dont_filter = response.meta.get("iframe_fallback", False)
             )
 
-    def _get_player_id_from_name(self, name, team_dic) :
-        """ Method that allows to get the id of a player from his name and the dic of his team
-        should accept names as : name, initials name """
-        potential = []
-        final = []
-        name = name.upper().strip()
-        for player_id , player_info in team_dic.items() :
-            player_name = player_info[0].upper().strip()
-            player_name_list = player_name.split(" ")
-            researched_name_list = name.split(" ")
-            if researched_name_list[-1] in player_name_list[-1] :
-                potential.append(player_id)
-        if len(potential) == 0 :
-            raise RuntimeError("no name was detected")
-        elif len(potential) == 1 :
-            return potential[0]
-        else:
-            #if all the potentials are equals :
-            if all(potential[0] == rest for rest in potential) :
-                return potential[0]
-            if len(name.split(" ")) == 1 :
-                raise RuntimeError("two many names containing the exact researched name")
-            else:
-                researched_first_leter = name.split(" ")[0][0]
-                researched_last_name = name.split(" ")[-1]
-                for potential_id in potential :
-                    potential_name = team_dic[potential_id][0].upper().strip()
-                    potential_first_letter = potential_name.split(" ")[0][0]
-                    potential_last_name = potential_name.split(" ")[-1]
-                    if potential_first_letter == researched_first_leter and potential_last_name == researched_last_name:
-                        final.append(potential_id)
-                if len(final) == 1:
-                    return final[0]
-                else:
-                    #if all final are equals we return it :
-                    if final and all(final[0] == rest for rest in final) :
-                        return final[0]
-                    raise RuntimeError ("could not find name")
+    def _match_iframe_direct_parse(self, response):
+        """ Callback of the iframes fetched without going through the match page.
+        Falls back to the match page if the response doesn't look like a match iframe.
+        """
+        if not response.xpath("//td[@class=\"liveSubNavText1\"]"):
+            self.logger.warning("[{}] Unexpected page at \"{}\", going through the match page".format(response.meta["match"]["id"], response.url))
+            self.crawler.stats.inc_value("espn/iframe/direct_fallback")
+            return [self._match_page_request(response.meta["match"], fallback = True)]
+
+        self.crawler.stats.inc_value("espn/iframe/direct_ok")
+        return self._match_iframe_callback(response)
 
+    def _match_iframe_direct_failed(self, failure):
+        request = failure.request
+        self.logger.warning("[{}] Direct iframe fetch failed ({}), going through the match page".format(request.meta["match"]["id"], failure.value))
+        self.crawler.stats.inc_value("espn/iframe/direct_fallback")
+        yield self._match_page_request(request.meta["match"], fallback = True)
 
     def _parse_match_stats(self, tab, match) :
         """ Parser that handles the content of the per-team "Stats" tab.
@@ -242,118 +453,103 @@ class ESPN(Spider):
             self.logger.error("[{}] No data in \"Match stats\" tab, aborting.".format(match["id"]))
             return
 
+        ids = [match["home_team_id"], match["away_team_id"]]
         for stat in stats:
-            title = stat.css("td:nth-child(2)::text").extract_first()
-            if not title:
+            cells = self._row_cells(stat)
+            if len(cells) < 3 or not cells[1]:
                 continue
-            values = [stat.css("td:nth-child({})::text".format(i)).extract_first() for i in [1, 3]]
-            ids = [match["home_team_id"], match["away_team_id"]]
+            title = cells[1]
+            spec = self.match_stats_registry.get(title)
+            if not spec:
+                self.logger.debug("[{}] Unknown match stat \"{}\"".format(match["id"], title))
+                self.crawler.stats.inc_value("espn/match_stats/unknown/{}".format(title.strip()))
+                continue
+            values = [cells[0], cells[2]]
             if not all(values):
                 continue
-            result = defaultdict(dict)
 
+            pattern, fields, transform = spec
+            result = defaultdict(dict)
             for team_id, value in zip(ids, values):
-                # Analysing the data itself
-                if title == "Penalty goals":
-                    cons_attempt_re = regex.match("[0-9]+ from ([0-9]+)", value)
-                    if not cons_attempt_re:
-                        continue
-                    result["pens_attempt"][team_id] = int(cons_attempt_re.captures(1)[0])
-                # Attempted drops
-                if title == "Dropped goals":
-                    drops_re = regex.match("([0-9]+)( \(([0-9]+) missed\))?", value)
-                    if not drops_re:
-                        continue
-                    drops_scored = int(drops_re.captures(1)[0])
-                    drops_missed = drops_re.captures(3)
-                    if not drops_missed:
-                        drops_missed = 0
-                    else:
-                        drops_missed = int(drops_missed[0])
-                    drops_attempt = drops_scored + drops_missed
-                    result["drops_attempt"][team_id] = drops_attempt
-                # Various metrics
-                codes = {
-                    "Kicks from hand": "kicks",
-                    "Passes": "passes",
-                    "Runs": "runs",
-                    "Metres run with ball": "meters",
-                    "Clean breaks": "breaks",
-                    "Defenders beaten": "def_beaten",
-                    "Offloads": "offloads",
-                    "Turnovers conceded": "turnovers",
-                    "Penalties conceded": "pens_conceded",
-                }
-                if title in ["Kicks from hand", "Passes", "Runs", "Metres run with ball", "Clean breaks", "Defenders beaten", "Offloads", "Turnovers conceded", "Penalties conceded"]:
-                    result[codes.get(title)][team_id] = int(value)
-                # Rucks both initiated and won
-                if title == "Rucks won":
-                    rucks_re = regex.match("^\\n([0-9]+) from ([0-9]+)", value)
-                    if not rucks_re:
-                        continue
-                    result["rucks_init"][team_id] = int(rucks_re.captures(2)[0])
-                    result["rucks_won"][team_id] = int(rucks_re.captures(1)[0])
-                #mauls both initiated and won
-                if title == "Mauls won":
-                    mall_re = regex.match("^\\n([0-9]+) from ([0-9]+)", value)
-                    if not mall_re :
-                        continue
-                    result["mall_init"][team_id] = int(mall_re.captures(2)[0])
-                    result["mall_won"][team_id] = int(mall_re.captures(1)[0])
-                #tackles
-                if title == "Tackles made/missed":
-                    tackles_re = regex.match("^([0-9]+)/([0-9]+)$", value)
-                    if not tackles_re :
-                        continue
-                    result["tackles_made"][team_id] = int(tackles_re.captures(1)[0])
-                    result["tackles_missed"][team_id] = int(tackles_re.captures(2)[0])
-                #scrums
-                if title == "Scrums on own feed":
-                    scrums_re = regex.match("^\\n\\t  ([0-9]+) won, ([0-9]+) lost", value)
-                    if not scrums_re:
-                        continue
-                    result["scrums_won_on_feed"][team_id] = int(scrums_re.captures(1)[0])
-                    result["scrums_lost_on_feed"][team_id] = int(scrums_re.captures(2)[0])
-                #lineouts
-                if title == "Lineouts on own throw":
-                    lineout_re = regex.match("^\\n\\t  ([0-9]+) won, ([0-9]+) lost", value)
-                    if not lineout_re:
-                        continue
-                    result["lineouts_won_on_throw"][team_id] = int(lineout_re.captures(1)[0])
-                    result["lineouts_lost_on_throw"][team_id] = int(lineout_re.captures(2)[0])
-                #cards
-                if title == "Yellow/red cards":
-                    cards_re = regex.match("^([0-9]+)/([0-9]+)$", value)
-                    if not cards_re:
-                        continue
-                    result["yellow_cards"][team_id] = int(cards_re.captures(1)[0])
-                    result["red_cards"][team_id] = int(cards_re.captures(2)[0])
+                parsed = pattern.match(value)
+                if not parsed:
+                    continue
+                numbers = [int(number) if number is not None else None for number in parsed.groups()]
+                for field, number in zip(fields, transform(*numbers) if transform else numbers):
+                    result[field][team_id] = number
 
             for metric_name, metric_values in result.items():
                 yield metric_name, metric_values
 
+    def _row_cells(self, row):
+        """ Returns the text of every cell of a table row in a single pass over its children,
+        as "td:nth-child(k)::text" would for each k (None for header cells and empty cells) """
+        cells = []
+        for cell in row.root.iterchildren():
+            if not isinstance(cell.tag, str):
+                # Comments and processing instructions aren't counted by nth-child
+                continue
+            text = None
+            if cell.tag == "td":
+                text = cell.text
+                if text is None:
+                    text = next((child.tail for child in cell if child.tail is not None), None)
+            cells.append(text)
+        return cells
+
+    def _player_stats_layout(self, tab):
+        """ Maps the fields of the "{team} stats" tab to their column index, using the column headers when
+        they can be recognized unambiguously and the default positions otherwise. Only a header row with as
+        many cells as the data rows is used, so that its cells line up with the data cells. """
+        layout = [(fields, position - 1) for fields, position, header in self.player_stats_columns]
+        rows = tab.css("table tr")
+        widths = [len(self._row_cells(row)) for row in rows if row.xpath("td")]
+        if not widths:
+            return layout
+        width = max(set(widths), key = widths.count)
+
+        for row in rows:
+            if not row.xpath("th"):
+                continue
+            # Same cells as _row_cells counts (every child element)
+            headers = [header.strip() for header in row.xpath("./*").xpath("string()").extract()]
+            if len(headers) != width:
+                continue
+            from_headers = []
+            for fields, position, pattern in self.player_stats_columns:
+                matches = [index for index, header in enumerate(headers) if pattern.search(header)]
+                if len(matches) != 1:
+                    break
+                from_headers.append((fields, matches[0]))
+            else:
+                return from_headers
+        return layout
 
-    def _parse_player_stats(self, row, potential_team, potential_team_id ):
-        """method that parses players match stats from row,
+    def _parse_player_stats(self, cells, layout, potential_team, potential_team_id):
+        """method that parses players match stats from the cells of a row,
         format : {"match_id" : "placeholder", "player_id" : int, }
         """
 
-        assert type(potential_team) is list, "potential teams must be in a list"
+        assert type(potential_team) is list, "potential teams (name indexes) must be in a list"
         assert type(potential_team_id) is list, "potential teams id must be in a list"
         assert len(potential_team) == len(potential_team_id) and len(potential_team) == 2, "potential teams and team ids must be of same length 2"
 
+        values = {}
+        for fields, index in layout:
+            if index < len(cells) and cells[index] is not None:
+                values[fields] = cells[index]
+
         player_stats = {}
         #getting the player name and deducing his id and his team id
-        player_name = row.css("td:nth-child(2)::text")
+        player_name = values.pop(("name",), None)
         if not player_name :
             return None
-        player_name = player_name.extract_first()
         try :
-            home_player_id = self._get_player_id_from_name(player_name, potential_team[0])
+            home_player_id = potential_team[0].resolve(player_name)
         except RuntimeError:
             home_player_id = None
         try:
-            away_player_id = self._get_player_id_from_name(player_name, potential_team[1])
+            away_player_id = potential_team[1].resolve(player_name)
         except RuntimeError:
             away_player_id = None
 
@@ -372,96 +568,27 @@ class ESPN(Spider):
         player_stats["player_id"] = player_id
         player_stats["team_id"] = team_id
 
-        #getting the statistics
-        #tries and assists
-        tries_assists = row.css("td:nth-child(3)::text")
-        if tries_assists:
-            tries_assists = tries_assists.extract_first()
-            tries_assists_re = regex.match("^([0-9]+)/([0-9])+$", tries_assists)
-            if tries_assists_re:
-                tries = int(tries_assists_re.captures(1)[0])
-                player_stats["tries"] = tries
-                assists = int(tries_assists_re.captures(2)[0])
-                player_stats["assists"] = assists
-        #points
-        points = row.css("td:nth-child(4)::text")
-        if points:
-            points = int(points.extract_first())
-            player_stats["points"] = points
-        #kicks runs passes
-        k_r_p = row.css("td:nth-child(5)::text")
-        if k_r_p:
-            k_r_p = k_r_p.extract_first()
-            k_r_p_re = regex.match("^([0-9]+)/([0-9]+)/([0-9]+)$", k_r_p)
-            if k_r_p_re:
-                kicks = int(k_r_p_re.captures(1)[0])
-                player_stats["kicks"] = kicks
-                passes = int(k_r_p_re.captures(2)[0])
-                player_stats["passes"] = passes
-                runs = int(k_r_p_re.captures(3)[0])
-                player_stats["runs"] = runs
-        #meters ran
-        meters_ran = row.css("td:nth-child(6)::text")
-        if meters_ran:
-            meters_ran = int(meters_ran.extract_first())
-            player_stats["meters"] = meters_ran
-        #clean breacks
-        breaks = row.css("td:nth-child(7)::text")
-        if breaks:
-            breaks = int(breaks.extract_first())
-            player_stats["breaks"] = breaks
-        #defenders beaten
-        defenders_beaten = row.css("td:nth-child(8)::text")
-        if defenders_beaten:
-            defenders_beaten = int(defenders_beaten.extract_first())
-            player_stats["def_beaten"] = defenders_beaten
-        #offloads
-        offloads = row.css("td:nth-child(9)::text")
-        if offloads:
-            offloads = int(offloads.extract_first())
-            player_stats["offloads"] = offloads
-        #turnovers
-        turnovers = row.css("td:nth-child(10)::text")
-        if turnovers:
-            turnovers = int(turnovers.extract_first())
-            player_stats["turnovers"] = turnovers
-        #tackles made and missed
-        tackles = row.css("td:nth-child(11)::text")
-        if tackles:
-            tackles = tackles.extract_first()
-            tackles_re = regex.match("^([0-9]+)/([0-9]+)", tackles)
-            if tackles_re:
-                tackles_made = int(tackles_re.captures(1)[0])
-                player_stats["tackles_made"] = tackles_made
-                tackles_missed = int(tackles_re.captures(2)[0])
-                player_stats["tackles_missed"] = tackles_missed
-        #lineouts
-        lineouts = row.css("td:nth-child(12)::text")
-        if lineouts:
-            lineouts = lineouts.extract_first()
-            lineouts_re = regex.match("^([0-9]+)/([0-9]+)$", lineouts)
-            if lineouts_re:
-                lineouts_won_on_throw = int(lineouts_re.captures(1)[0])
-                player_stats["lineouts_won_on_throw"] = lineouts_won_on_throw
-                lineouts_stolen_from_opp = int(lineouts_re.captures(2)[0])
-                player_stats["lineouts_stolen_from_opp"] = lineouts_stolen_from_opp
-        #penalties conceded
-        pens_conceded = row.css("td:nth-child(13)::text")
-        if pens_conceded:
-            pens_conceded = int(pens_conceded.extract_first())
-            player_stats["pens_conceded"] = pens_conceded
-        #cards
-        cards = row.css("td:nth-child(14)::text")
-        if cards:
-            cards = cards.extract_first()
-            cards_re = regex.match("^([0-9]+)/([0-9]+)", cards)
-            if cards_re:
-                player_stats["yellow_cards"] = int(cards_re.captures(1)[0])
-                player_stats["red_cards"] = int(cards_re.captures(2)[0])
+        #getting the statistics, single values and "a/b" or "a/b/c" cells alike
+        for fields, value in values.items():
+            numbers = parse_compound(value, len(fields))
+            if numbers:
+                player_stats.update(zip(fields, numbers))
+            elif missing_values(value.strip()):
+                self.crawler.stats.inc_value("espn/player_stats/rejected_cells")
 
         return player_stats
 
 
+    @traced
+    def _match_iframe_callback(self, response):
+        """ Parses the match iframe in the reactor thread, or sends it to the worker processes if there are any
+        (the returned Deferred then fires with the items and requests once a worker is done with it)
+        """
+        if self.parse_pool is None:
+            return self._match_iframe_parse(response)
+        self.crawler.stats.inc_value("espn/iframe/offloaded")
+        return self.parse_pool.parse_iframe(response).addCallback(lambda records: self.parse_pool.to_results(self, response, records))
+
     def _match_iframe_parse(self, response):
         """ Main callback that handles the parsing of the match iframe containing most of the data.
         Returns PlayerStats() (enriched) per player, MatchExtraStats() and PlayerExtraStats() if available.
@@ -568,11 +695,13 @@ class ESPN(Spider):
                         continue
 
                     # Go to the player page to scrape it
-                    yield response.follow(
-                        url = "/statsguru/rugby/player/{}.html".format(player_info["id"]),
-                        callback = self.player_info_parse,
-                        meta = { "player_info" : player_info }
-                    )
+                    request = self._player_request(response, player_info)
+                    if request:
+                        yield request
+                    # Store the player right away, so that the stats below never reference a missing player
+                    # (the profile is merged into it later). DBs enforcing foreign keys depend on it.
+                    if player_info.get("name"):
+                        yield Player(player_info)
 
                     player_stats_fields = {
                         "number" : "td.liveTblTextGrn::text",
@@ -601,6 +730,9 @@ class ESPN(Spider):
             return
         self.logger.info("[{}] Found {} players for home team ({}) and {} players for away team ({})".format(match["id"], len(player_dict["home"]), match["home_team_id"], len(player_dict["away"]), match["away_team_id"]))
 
+        # Index the player names once, for the scorers and the player stats
+        name_index = { side: PlayerNameIndex(players) for side, players in player_dict.items() }
+
         # 3) Parse top summary of the Teams tab to retrieve the names of the players who scored
         self.logger.info("[{}] Begin score parsing ...".format(match["id"]))
         scores = tabs["Teams"].css(".liveTblScorers")
@@ -661,7 +793,7 @@ class ESPN(Spider):
 
                         # Attempt to guess the player id
                         try :
-                            player_id = self._get_player_id_from_name(name, player_dict["home" if index == 0 else "away"])
+                            player_id = name_index["home" if index == 0 else "away"].resolve(name)
                         except RuntimeError:
                             # Drop game events that can't be associated to a player
                             self.logger.warning("[{}] ({}) Unable to guess player id for \"{}\". Skipping.".format(match["id"], event_type, name))
@@ -731,8 +863,9 @@ class ESPN(Spider):
 
         # 4) If available, parse the "{team} stats" page which provides player-level statistics
         for index, tab in enumerate((tabs[title] for title in tabs.keys() if regex.search("^[a-zA-Z ]+ stats$", title))):
+            layout = self._player_stats_layout(tab)
             for player_row in tab.css("table tr") :
-                player_stats = self._parse_player_stats(player_row, potential_team = [player_dict["home"], player_dict["away"]], potential_team_id = [match["home_team_id"], match["away_team_id"]])
+                player_stats = self._parse_player_stats(self._row_cells(player_row), layout, potential_team = [name_index["home"], name_index["away"]], potential_team_id = [match["home_team_id"], match["away_team_id"]])
                 if player_stats:
                     loader = PlayerExtraStatsLoader(item = PlayerExtraStats())
                     loader.add_value("match_id", match["id"])
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+# Storage backends of RugbyScraperPipeline, selected with the STORAGE_BACKEND setting.
+# The pipeline buffers the items and hands them over in batches, the backend writes
+# each batch in a single transaction. Backends are only used from one thread (the
+# writer thread of the pipeline), from open() to close().
+
+import io
+import sqlite3
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from rugby import models, items, database, aggregates
+
+class Storage(object):
+    """ Base of the storage backends : writes batches of items (item class -> list of dicts) to the models' tables,
+    with SQLAlchemy Core statements. Backends override the write methods with faster ones for their DB. """
+
+    # Item class -> (model, write strategy, key columns). The order of this dict
+    # is the order in which buffered tables are flushed (parents first).
+    # "refresh" upserts the rows of new IDs, and the rows of known IDs only if they
+    # carry a fetched profile (fetched_at) : other rows are identity cache hits.
+    tables = OrderedDict([
+        (items.Team, (models.Team, "unique", ("id",))),
+        (items.Player, (models.Player, "refresh", ("id",))),
+        (items.Match, (models.Match, "unique", ("id",))),
+        (items.MatchStats, (models.MatchStats, "upsert", ("match_id", "team_id"))),
+        (items.MatchExtraStats, (models.MatchExtraStats, "upsert", ("match_id", "team_id"))),
+        (items.PlayerStats, (models.PlayerStats, "upsert", ("player_id", "team_id", "match_id"))),
+        (items.PlayerExtraStats, (models.PlayerExtraStats, "upsert", ("player_id", "team_id", "match_id"))),
+        (items.GameEvent, (models.GameEvent, "insert", ())),
+    ])
+
+    # Maximum number of bound parameters in a single "IN (...)" clause
+    chunk_size = 500
+
+    def __init__(self, settings, stats):
+        self.settings = settings
+        self.stats = stats
+
+        # Refresh the aggregate tables along with the stats of every batch
+        self.aggregates = settings.getbool("PIPELINE_AGGREGATES", True)
+
+        # IDs already stored in the "unique" and "refresh" tables, loaded when the spider opens
+        self.known_ids = {}
+        self.pending_ids = defaultdict(list)
+        self.upsert_statements = {}
+
+        # Connect to DB
+        self.engine = database.get_engine(settings)
+        self.session = sessionmaker(bind = self.engine)
+        self.connection = None
+
+    @classmethod
+    def from_settings(cls, settings, stats):
+        return cls(settings, stats)
+
+    def open(self, logger):
+        """ Opens the connection used for all the writes until close(), configured for bulk loading """
+        self.logger = logger
+        self._load_known_ids()
+        self.connection = self.engine.connect()
+        self._configure(self.connection)
+
+    def close(self):
+        if self.connection is not None:
+            self._checkpoint(self.connection)
+            self.connection.close()
+            self.connection = None
+        self.engine.dispose()
+
+    def _configure(self, connection):
+        """ Tunes the writer connection, once it is opened """
+
+    def _checkpoint(self, connection):
+        """ Makes the written data durable, before the writer connection gets closed """
+
+    def _load_known_ids(self):
+        """ Loads the primary keys of the tables de-duplicated by ID, so that repeated lookups never reach the DB """
+        for model, strategy, keys in self.tables.values():
+            if strategy in ("unique", "refresh"):
+                self.known_ids[model] = database.get_ids(self.engine, model)
+                self.logger.info("Loaded {} existing IDs from \"{}\"".format(len(self.known_ids[model]), model.__tablename__))
+
+    def write(self, batch):
+        """ Writes a batch in a single transaction, with bulk statements per table. Returns False if it was rolled back. """
+        session = self.session(bind = self.connection)
+        try:
+            for item_class, (model, strategy, keys) in self.tables.items():
+                rows = batch.get(item_class)
+                if not rows:
+                    continue
+                if strategy == "unique":
+                    self._unique_insert(session, model, rows)
+                elif strategy == "refresh":
+                    self._refresh(session, model, self._merge(rows, keys), keys)
+                elif strategy == "upsert":
+                    self._upsert(session, model, self._merge(rows, keys), keys)
+                else:
+                    self._insert(session, model, rows)
+                self.stats.inc_value("pipeline/flush/items/{}".format(model.__tablename__), len(rows))
+            if self.aggregates:
+                players, team_seasons = aggregates.refresh(session, batch)
+                self.stats.inc_value("pipeline/aggregates/players", players)
+                self.stats.inc_value("pipeline/aggregates/team_seasons", team_seasons)
+            session.commit()
+            # Only remember the new IDs once they are actually stored
+            for model, ids in self.pending_ids.items():
+                self.known_ids[model].update(ids)
+            return True
+        except Exception as e:
+            session.rollback()
+            self.logger.error("Error while committing to DB : {}".format(e))
+            return False
+        finally:
+            self.pending_ids.clear()
+            session.close()
+
+    def _chunks(self, values):
+        values = list(values)
+        for i in range(0, len(values), self.chunk_size):
+            yield values[i:i + self.chunk_size]
+
+    def _unique_insert(self, session, model, rows):
+        # The first occurrence of an ID wins, both within the batch and against the DB
+        known = self.known_ids[model]
+        unique_rows = OrderedDict()
+        for row in rows:
+            if row["id"] in known or row["id"] in unique_rows:
+                continue
+            unique_rows[row["id"]] = row
+
+        hits = len(rows) - len(unique_rows)
+        self.stats.inc_value("pipeline/identity_cache/hits", hits)
+        self.stats.inc_value("pipeline/identity_cache/misses", len(unique_rows))
+        if hits:
+            self.logger.debug("{} \"{}\" entries already existing in DB".format(hits, model.__tablename__))
+
+        self.pending_ids[model].extend(unique_rows.keys())
+        if unique_rows:
+            self._insert_new(session, model, list(unique_rows.values()))
+
+    def _refresh(self, session, model, merged, keys):
+        known = self.known_ids[model]
+        rows = OrderedDict((key, row) for key, row in merged.items() if int(row["id"]) not in known or row.get("fetched_at"))
+
+        hits = len(merged) - len(rows)
+        self.stats.inc_value("pipeline/identity_cache/hits", hits)
+        self.stats.inc_value("pipeline/identity_cache/misses", len(rows))
+
+        self.pending_ids[model].extend(int(row["id"]) for row in rows.values())
+        if rows:
+            self._upsert(session, model, rows, keys)
+
+    def _merge(self, rows, keys):
+        # Successive partial items for the same entry are merged, later values win.
+        # Loaders never output empty fields, so only non-null values get merged.
+        merged = OrderedDict()
+        for row in rows:
+            merged.setdefault(tuple(row[key] for key in keys), {}).update(row)
+        return merged
+
+    def _groups(self, model, rows):
+        """ Groups rows by set of columns, as bulk statements need the same columns for every row.
+        NOT NULL columns missing from partial items get their default when inserting,
+        but are left untouched when updating an existing entry.
+        """
+        groups = defaultdict(list)
+        for row in rows:
+            defaults = {
+                column.name: column.default.arg for column in model.__table__.columns
+                if column.name not in row and not column.nullable and column.default is not None and column.default.is_scalar
+            }
+            groups[(tuple(sorted(row.keys())), tuple(sorted(defaults.keys())))].append(dict(row, **defaults))
+        return groups
+
+    def _upsert_sql(self, table, columns, defaults, keys, source, update = True):
+        """ "INSERT ... ON CONFLICT DO UPDATE" statement (SQLite 3.24+ and PostgreSQL 9.5+) : existing
+        entries are only updated with the non-null fields of the new rows """
+        updates = ["{0} = COALESCE(excluded.{0}, {1}.{0})".format(column, table.name) for column in columns if column not in keys and update]
+        return "INSERT INTO {} ({}) {} ON CONFLICT ({}) DO {}".format(
+            table.name,
+            ", ".join(columns + defaults),
+            source,
+            ", ".join(keys),
+            "UPDATE SET " + ", ".join(updates) if updates else "NOTHING",
+        )
+
+    def _insert(self, session, model, rows):
+        """ Inserts rows with one executemany() statement per set of columns """
+        for (columns, defaults), group in self._groups(model, rows).items():
+            self.logger.debug("Inserting {} entries in \"{}\"".format(len(group), model.__tablename__))
+            session.execute(model.__table__.insert(), group)
+
+    def _insert_new(self, session, model, rows):
+        """ Inserts rows whose IDs weren't known to be stored yet """
+        self._insert(session, model, rows)
+
+    def _upsert(self, session, model, merged, keys):
+        """ Writes rows with one "INSERT ... ON CONFLICT DO UPDATE" statement per set of columns """
+        for (columns, defaults), group in self._groups(model, merged.values()).items():
+            self.logger.debug("Upserting {} entries in \"{}\"".format(len(group), model.__tablename__))
+            session.execute(self._upsert_statement(model.__table__, columns, defaults, keys), group)
+
+    def _upsert_statement(self, table, columns, defaults, keys):
+        cache_key = (table.name, columns, defaults)
+        if cache_key not in self.upsert_statements:
+            values = "VALUES ({})".format(", ".join(":" + column for column in columns + defaults))
+            self.upsert_statements[cache_key] = text(self._upsert_sql(table, columns, defaults, keys, values))
+        return self.upsert_statements[cache_key]
+
+class SQLiteStorage(Storage):
+    """ Storage in the SQLite DB of SQLITE_ABS_PATH, with executemany() statements """
+
+    def __init__(self, settings, stats):
+        super(SQLiteStorage, self).__init__(settings, stats)
+        # "INSERT ... ON CONFLICT DO UPDATE" is only available from SQLite 3.24
+        self.supports_upsert = sqlite3.sqlite_version_info >= (3, 24, 0)
+        self.journal_mode = settings.get("SQLITE_JOURNAL_MODE", "WAL")
+        self.synchronous = settings.get("SQLITE_SYNCHRONOUS", "NORMAL")
+
+    def _configure(self, connection):
+        # WAL lets readers use the DB during the crawl, and with "synchronous = NORMAL" commits
+        # no longer wait for an fsync (a power loss may lose the last commits, never corrupt the DB)
+        if self.journal_mode:
+            mode = connection.execute("PRAGMA journal_mode = {}".format(self.journal_mode)).scalar()
+            self.logger.info("SQLite journal mode : {}".format(mode))
+        if self.synchronous:
+            connection.execute("PRAGMA synchronous = {}".format(self.synchronous))
+        connection.execute("PRAGMA temp_store = MEMORY")
+
+    def _checkpoint(self, connection):
+        # Copy the WAL back into the DB file and truncate it, so that the DB is a single file again
+        if self.journal_mode and self.journal_mode.upper() == "WAL":
+            busy, pages, checkpointed = connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            if busy:
+                self.logger.warning("WAL checkpoint incomplete, the DB is used by another connection")
+            else:
+                self.logger.info("WAL written back to the DB")
+
+    def _insert(self, session, model, rows):
+        self.logger.debug("Inserting {} entries in \"{}\"".format(len(rows), model.__tablename__))
+        session.bulk_insert_mappings(model, rows)
+
+    def _upsert(self, session, model, merged, keys):
+        if not self.supports_upsert:
+            return self._insert_or_update(session, model, merged, keys)
+        super(SQLiteStorage, self)._upsert(session, model, merged, keys)
+
+    def _insert_or_update(self, session, model, merged, keys):
+        """ Fallback of _upsert for SQLite versions without "ON CONFLICT" support. Existing entries are
+        looked up by the first key column (the leading column of the unique index), then by the whole key.
+        Keys are integer IDs, scraped player IDs being strings. """
+        merged = OrderedDict((tuple(int(value) for value in key), row) for key, row in merged.items())
+        existing = {}
+        column = getattr(model, keys[0])
+        for values in self._chunks({key[0] for key in merged.keys()}):
+            for entry in session.query(model).filter(column.in_(values)):
+                existing[tuple(getattr(entry, key) for key in keys)] = entry.id
+
+        updates = [dict(row, id = existing[key]) for key, row in merged.items() if key in existing]
+        inserts = [row for key, row in merged.items() if key not in existing]
+
+        if updates:
+            self.logger.debug("Updating {} entries in \"{}\"".format(len(updates), model.__tablename__))
+            session.bulk_update_mappings(model, updates)
+        if inserts:
+            self._insert(session, model, inserts)
+
+class PostgresStorage(Storage):
+    """ Storage in the PostgreSQL DB of DATABASE_URL (needs psycopg2). Rows are streamed with COPY :
+    straight into the tables for plain inserts, and into temporary staging tables otherwise, which
+    are then merged into the tables with one "INSERT ... SELECT ... ON CONFLICT" statement.
+    Several crawlers can write to the same DB : entries inserted by another one are skipped or merged.
+    """
+
+    def __init__(self, settings, stats):
+        super(PostgresStorage, self).__init__(settings, stats)
+        if self.engine.dialect.name != "postgresql":
+            raise ValueError("PostgresStorage needs a PostgreSQL DATABASE_URL, not \"{}\"".format(self.engine.url))
+        self.synchronous_commit = settings.get("POSTGRES_SYNCHRONOUS_COMMIT", "off")
+
+    def _configure(self, connection):
+        # Commits return before the WAL is flushed to disk (a crash may lose the last commits, never corrupt the DB)
+        if self.synchronous_commit:
+            connection.execute(text("SET synchronous_commit TO {}".format(self.synchronous_commit)).execution_options(autocommit = True))
+
+    def _copy_value(self, value):
+        # Text format of COPY : tab-separated, \N for NULL, backslash escapes
+        if value is None:
+            return "\\N"
+        if isinstance(value, bool):
+            return "t" if value else "f"
+        return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+    def _copy(self, session, table, columns, rows):
+        """ Streams rows to a table with COPY, in the same transaction as the session """
+        data = io.StringIO()
+        for row in rows:
+            data.write("\t".join(self._copy_value(row.get(column)) for column in columns))
+            data.write("\n")
+        data.seek(0)
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.copy_expert("COPY {} ({}) FROM STDIN".format(table, ", ".join(columns)), data)
+        finally:
+            cursor.close()
+
+    def _insert(self, session, model, rows):
+        for (columns, defaults), group in self._groups(model, rows).items():
+            self.logger.debug("Copying {} entries to \"{}\"".format(len(group), model.__tablename__))
+            self._copy(session, model.__tablename__, columns + defaults, group)
+
+    def _insert_new(self, session, model, rows):
+        # IDs may have been stored by another crawler since they were loaded
+        self._staged_upsert(session, model, rows, ("id",), update = False)
+
+    def _upsert(self, session, model, merged, keys):
+        self._staged_upsert(session, model, merged.values(), keys)
+
+    def _staged_upsert(self, session, model, rows, keys, update = True):
+        table = model.__table__
+        # One staging table per table and connection, emptied after every use (creating temporary
+        # tables in every transaction costs more than the COPY itself)
+        staging = "staging_{}".format(table.name)
+        session.execute(text("CREATE TEMPORARY TABLE IF NOT EXISTS {} AS SELECT * FROM {} WITH NO DATA".format(staging, table.name)))
+        for (columns, defaults), group in self._groups(model, rows).items():
+            self.logger.debug("Merging {} entries into \"{}\"".format(len(group), table.name))
+            self._copy(session, staging, columns + defaults, group)
+            source = "SELECT {} FROM {}".format(", ".join(columns + defaults), staging)
+            session.execute(text(self._upsert_sql(table, columns, defaults, keys, source, update) + "; DELETE FROM {}".format(staging)))
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+""" Per-match latency traces, from the discovery of a match on a list page to the commit of its data.
+
+Each request of a match carries a trace in its meta (match ID, stage, time it was queued at). When the
+response gets parsed, the time spent waiting (scheduler, downloader slot, scraper queue), downloading and
+parsing is recorded as spans of the match. The pipeline then records how long the items stayed buffered and
+how long the write took. Traces are written as JSON lines when the spider closes (see TRACE_FILE) :
+
+    python -m rugby.tracing /tmp/traces.jsonl
+"""
+
+import sys
+import json
+import time
+import functools
+from collections import OrderedDict, defaultdict
+
+from scrapy import signals
+from twisted.internet import defer
+
+class MatchTracer(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.traces = OrderedDict()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """ Returns a tracer exporting to TRACE_FILE when the spider closes, or None if tracing is disabled """
+        path = crawler.settings.get("TRACE_FILE")
+        if not path:
+            return None
+        tracer = cls(path)
+        crawler.signals.connect(tracer.spider_closed, signal = signals.spider_closed)
+        return tracer
+
+    def _trace(self, match_id):
+        if match_id not in self.traces:
+            self.traces[match_id] = {"match_id": match_id, "discovered": time.time(), "parsed": None, "committed": None, "spans": defaultdict(float)}
+        return self.traces[match_id]
+
+    def discovered(self, match_id):
+        self._trace(match_id)
+
+    def request(self, match_id, stage):
+        """ Returns the trace to carry in the meta of a request of the given stage ("match_page", "iframe") """
+        self._trace(match_id)
+        return {"match_id": match_id, "stage": stage, "queued": time.time()}
+
+    def span(self, match_id, name, duration):
+        self._trace(match_id)["spans"][name] += duration
+
+    def received(self, meta):
+        """ Records the wait and download time of the response of a traced request """
+        trace = meta["trace"]
+        download = meta.get("download_latency", 0)
+        self.span(trace["match_id"], "{}/wait".format(trace["stage"]), max(0, time.time() - trace["queued"] - download))
+        self.span(trace["match_id"], "{}/download".format(trace["stage"]), download)
+
+    def parsed(self, meta, duration):
+        trace = meta["trace"]
+        self.span(trace["match_id"], "{}/parse".format(trace["stage"]), duration)
+        self._trace(trace["match_id"])["parsed"] = time.time()
+
+    def written(self, match_ids, start, end):
+        """ Records a committed write of items of the given matches """
+        for match_id in set(match_ids):
+            trace = self.traces.get(match_id)
+            if trace is None:
+                continue
+            # Time between the end of the parsing and the first write
+            if trace["parsed"] is not None and trace["parsed"] <= start and trace["committed"] is None:
+                trace["spans"]["buffer"] += max(0, start - trace["parsed"])
+            trace["spans"]["write"] += end - start
+            trace["committed"] = end
+
+    def spider_closed(self, spider):
+        with open(self.path, "w") as f:
+            for trace in self.traces.values():
+                record = dict(trace, spans = dict(trace["spans"]))
+                if trace["committed"] is not None:
+                    record["total"] = trace["committed"] - trace["discovered"]
+                f.write(json.dumps(record) + "\n")
+        spider.logger.info("Wrote {} match traces to \"{}\"".format(len(self.traces), self.path))
+
+def traced(callback):
+    """ Decorator recording the wait, download and parse time of the traced responses of a spider callback.
+    Only the time spent inside the callback counts as parse time, not the processing of what it yields.
+    """
+    @functools.wraps(callback)
+    def wrapper(spider, response):
+        tracer = getattr(spider, "tracer", None)
+        results = callback(spider, response)
+        if tracer is None or "trace" not in response.meta or results is None:
+            return results
+        tracer.received(response.meta)
+        if isinstance(results, defer.Deferred):
+            # Parsed out of the reactor thread : the parse time is the time until the results come back
+            start = time.time()
+            return results.addCallback(_parsed, tracer, response.meta, start)
+        return _timed(tracer, response.meta, results)
+    return wrapper
+
+def _parsed(results, tracer, meta, start):
+    tracer.parsed(meta, time.time() - start)
+    return results
+
+def _timed(tracer, meta, results):
+    duration = 0
+    iterator = iter(results)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                result = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                duration += time.perf_counter() - start
+            yield result
+    finally:
+        tracer.parsed(meta, duration)
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def report(path):
+    """ Prints the percentiles of each stage over the traces of a file """
+    stages = defaultdict(list)
+    count, complete = 0, 0
+    with open(path) as f:
+        for line in f:
+            trace = json.loads(line)
+            count += 1
+            for name, duration in trace["spans"].items():
+                stages[name].append(duration)
+            if "total" in trace:
+                complete += 1
+                stages["total"].append(trace["total"])
+
+    print("{} matches traced, {} written to the DB".format(count, complete))
+    print("{:<20} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10}".format("stage (s)", "count", "p50", "p90", "p99", "max", "sum"))
+    order = ["match_page/wait", "match_page/download", "match_page/parse", "iframe/wait", "iframe/download", "iframe/parse", "buffer", "write", "total"]
+    for name in sorted(stages.keys(), key = lambda name: order.index(name) if name in order else len(order)):
+        values = stages[name]
+        print("{:<20} {:>7} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.1f}".format(
+            name, len(values), percentile(values, 0.5), percentile(values, 0.9), percentile(values, 0.99), max(values), sum(values)))
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("Usage : python -m rugby.tracing TRACE_FILE")
+    report(sys.argv[1])
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+""" Parsing of the match iframes in a pool of worker processes (see PARSE_WORKERS).
+
+The raw iframe and the match data are sent to a worker, which runs the usual parser and sends back
+plain records : items as (class name, dict), player pages as the player data (the requests are built
+by the spider, which knows which profiles are fresh), along with the stats increments and log
+messages of the parse. The reactor keeps downloading while the workers parse.
+"""
+
+import logging
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from scrapy import Item
+from scrapy.http import HtmlResponse, Request
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+from rugby import items
+from rugby.spiders.espn import ESPN
+
+class ParsePool(object):
+
+    def __init__(self, workers, log_level = "DEBUG"):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(workers, initializer = init_worker, initargs = (log_level,))
+
+    @classmethod
+    def from_settings(cls, settings):
+        """ Returns a pool of PARSE_WORKERS processes, or None to parse in the reactor thread """
+        workers = settings.getint("PARSE_WORKERS", 0)
+        return cls(workers, settings.get("LOG_LEVEL", "DEBUG")) if workers > 0 else None
+
+    def parse_iframe(self, response):
+        """ Returns a Deferred firing with the records of a match iframe """
+        deferred = defer.Deferred()
+        future = self.executor.submit(parse_iframe, response.url, response.body, response.encoding, dict(response.meta["match"]))
+        # Futures complete in a thread of the executor, Deferreds must be fired from the reactor thread
+        future.add_done_callback(lambda future: reactor.callFromThread(self._fire, deferred, future))
+        return deferred
+
+    def _fire(self, deferred, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            deferred.errback(Failure(e))
+        else:
+            deferred.callback(result)
+
+    def close(self):
+        self.executor.shutdown()
+
+    @staticmethod
+    def to_results(spider, response, records):
+        """ Turns the records of a worker back into items and requests (in the reactor thread) """
+        for level, message in records["logs"]:
+            spider.logger.log(level, message)
+        for key, count in records["stats"].items():
+            spider.crawler.stats.inc_value(key, count)
+
+        results = []
+        for kind, data in records["results"]:
+            if kind == "Player request":
+                request = spider._player_request(response, items.Player(data))
+                if request:
+                    results.append(request)
+            else:
+                results.append(getattr(items, kind)(data))
+        return results
+
+class WorkerStats(object):
+    """ Stats increments of a parse, merged into the crawl stats by the spider """
+
+    def __init__(self):
+        self.values = defaultdict(int)
+
+    def inc_value(self, key, count = 1, start = 0):
+        self.values[key] += count
+
+class WorkerCrawler(object):
+
+    def __init__(self):
+        self.stats = WorkerStats()
+
+class IframeParser(ESPN):
+    """ Spider parsing the iframes in a worker process : player pages are returned as records instead of requests """
+
+    def _player_request(self, response, player_info):
+        return ("Player request", dict(player_info))
+
+class LogRecords(logging.Handler):
+
+    def __init__(self):
+        super(LogRecords, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+# Parser of the current worker process, created when the process starts
+parser = None
+
+def init_worker(log_level):
+    """ Creates the parser of a worker process, logging at the LOG_LEVEL of the crawl """
+    global parser
+    parser = IframeParser()
+    # Messages are sent back to the spider instead of going through the handlers inherited from the crawl
+    parser.logger.logger.setLevel(log_level)
+    parser.logger.logger.propagate = False
+
+def parse_iframe(url, body, encoding, match):
+    """ Parses a match iframe in a worker, returns its results, stats increments and log messages as plain data """
+    parser.crawler = WorkerCrawler()
+
+    handler = LogRecords()
+    parser.logger.logger.addHandler(handler)
+    try:
+        response = HtmlResponse(url = url, body = body, encoding = encoding, request = Request(url, meta = {"match": items.Match(match)}))
+        results = []
+        for result in parser._match_iframe_parse(response):
+            if isinstance(result, Item):
+                results.append((type(result).__name__, dict(result)))
+            else:
+                results.append(result)
+    finally:
+        parser.logger.logger.removeHandler(handler)
+
+    return {"results": results, "stats": dict(parser.crawler.stats.values), "logs": handler.records}